@@ -0,0 +1,136 @@
+"""
+Benchmarks for pyserve and jsonip. Each command prints a small table;
+run them with
+
+    python bench.py <command> [--options]
+"""
+
+import socket as sockets
+import statistics
+import time
+
+import argh
+import msgpack
+
+import jsonip
+import pyserve
+import pyserve27
+from pyservertools import call, msgframe
+
+BROADCAST = {
+    "time": 0.,
+    "id": 0,
+    "entities": [{"id": i, "pos": [i * 1., i * 2., i * 3.], "name": f"entity{i}"} for i in range(32)]
+}
+
+def drain(sock: sockets.socket):
+    try:
+        while sock.recv(1 << 16):
+            pass
+    except OSError:
+        pass
+
+def broadcast(clients: int, rounds: int, encode, once: bool) -> tuple[float, float]:
+    "seconds per broadcast spent encoding and in total, writing to clients socketpairs"
+    pairs = [sockets.socketpair() for _ in range(clients)]
+    for _, reader in pairs:
+        call(lambda reader=reader: drain(reader))
+    encoding = 0.
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if once:
+            t = time.perf_counter()
+            frame = encode(BROADCAST)
+            encoding += time.perf_counter() - t
+            for writer, _ in pairs:
+                writer.sendall(frame)
+        else:
+            for writer, _ in pairs:
+                t = time.perf_counter()
+                frame = encode(BROADCAST)
+                encoding += time.perf_counter() - t
+                writer.sendall(frame)
+    total = time.perf_counter() - start
+    for writer, reader in pairs:
+        writer.close()
+        reader.close()
+    return encoding / rounds, total / rounds
+
+def fanout(rounds: int=500, clients: str="1,4,16,64,256"):
+    """
+    microseconds per broadcast spent encoding, and in total, when the payload
+    is encoded for each client ("each") vs once and shared ("once")
+    """
+    print(f"{'codec':<8}{'clients':>8}{'encode each':>14}{'encode once':>14}{'total each':>14}{'total once':>14}")
+    for codec, encode in (("msgpack", msgframe), ("json", jsonip.jsonframe)):
+        for n in map(int, clients.split(",")):
+            eachEncode, eachTotal = broadcast(n, rounds, encode, once=False)
+            onceEncode, onceTotal = broadcast(n, rounds, encode, once=True)
+            print(f"{codec:<8}{n:>8}{eachEncode * 1e6:>14.1f}{onceEncode * 1e6:>14.1f}{eachTotal * 1e6:>14.1f}{onceTotal * 1e6:>14.1f}")
+
+def roundtrips(ip: pyserve.Address, rounds: int, payload: str) -> list[float]:
+    "seconds for each of rounds sequential calls through a PyServer at ip"
+    server = pyserve.PyServer({"echo": lambda x: x}, ip=ip)
+    server.accept_clients()
+    call(server.operate)
+    client = pyserve27.PyClient(ip=pyserve27.Address(ip.addr, ip.port, ip.path, ip.shm))
+    for _ in range(100): # warm up
+        client.result(client.call_nowait("echo", payload))
+    times = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        client.result(client.call_nowait("echo", payload))
+        times.append(time.perf_counter() - t)
+    client.close()
+    return times
+
+def transport(rounds: int=5000, sizes: str="16,1024,65536", port: int=31790, path: str="/tmp/pyserve-bench.sock",
+              shm: str="/dev/shm/pyserve-bench"):
+    """
+    p50/p99 round trip in microseconds of one echo call over loopback TCP,
+    an AF_UNIX socket and the shared memory rings, for each payload size in
+    bytes. the rings only pay off with a spare core for each side to spin on
+    """
+    print(f"{'bytes':>8}{'tcp p50':>10}{'tcp p99':>10}{'unix p50':>10}{'unix p99':>10}{'shm p50':>10}{'shm p99':>10}")
+    for i, size in enumerate(map(int, sizes.split(","))):
+        payload = "x" * size
+        tcp = roundtrips(pyserve.Address("127.0.0.1", port + i), rounds, payload)
+        unix = roundtrips(pyserve.Address(path=f"{path}.{i}"), rounds, payload)
+        ring = roundtrips(pyserve.Address(shm=f"{shm}.{i}"), rounds, payload)
+        row = []
+        for times in (tcp, unix, ring):
+            cuts = statistics.quantiles(times, n=100)
+            row += [cuts[49] * 1e6, cuts[98] * 1e6]
+        print(f"{size:>8}" + "".join(f"{t:>10.1f}" for t in row))
+
+
+def decode(rounds: int=100000, args: str="name,1,2.5"):
+    """
+    frame size and microseconds per request to unpack a call and resolve its
+    function and arguments, for a pre-protocol 2 packet with every string as
+    bin, a protocol 2 packet and a positional frame
+    """
+    dispatcher = pyserve.Dispatcher({"update": print}, threads=1, processes=1)
+    values = [int(a) if a.isdigit() else float(a) if a.replace(".", "", 1).isdigit() else a for a in args.split(",")]
+    legacy = [a.encode() if isinstance(a, str) else a for a in values]
+    cases = (
+        ("legacy", msgpack.dumps({b"f": b"update", b"a": legacy, b"i": 1}, use_bin_type=True), False),
+        ("named", msgpack.dumps({"f": "update", "a": values, "i": 1}, use_bin_type=True), False),
+        ("positional", msgpack.dumps([0, 1, values], use_bin_type=True), True),
+    )
+    print(f"{'frame':<12}{'bytes':>8}{'us/request':>12}")
+    for name, frame, positional in cases:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = msgpack.loads(frame, raw=False)
+            if positional:
+                data = dispatcher.expand(data)
+            dispatcher.resolve(data)
+        print(f"{name:<12}{len(frame):>8}{(time.perf_counter() - start) / rounds * 1e6:>12.2f}")
+
+
+parser = argh.ArghParser()
+parser.add_commands([fanout, transport, decode])
+
+if __name__ == "__main__":
+    parser.dispatch()
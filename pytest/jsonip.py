@@ -32,6 +32,7 @@ import time
 import random
 
 from logger import *
+from pyservertools import Queue
 
 ENCODING = "utf-8"
 ZERO_STRING = "0"
@@ -46,16 +47,18 @@ def call(func: type(lambda:0)) -> threading.Thread: # type(lambda:0) shows up as
 # NOTICE: jsonsend and jsonrecv are directly derived from
 # the functions _recv and _send in jsonsocket.py, created by
 # mdebbar. The original functions do not, however, work as-is.
+def jsonframe(data: dict) -> bytes:
+    "encodes data as a complete jsonsend packet, ready to be written to any number of sockets"
+    serialised = bytes(json.dumps(data), encoding=ENCODING)
+    return bytes(str(len(serialised)).rjust(DENARY_MAX_LENGTH_DIGITS, ZERO_STRING), ENCODING) + serialised
+
 def jsonsend(socket: socket.socket, data: dict):
     "send a json packet over the given socket"
     """
     Note: the newline terminates the bytes count AND is
     not included in the bytes count figure.
     """
-    serialised = json.dumps(data)
-    msg = bytes(str(len(serialised)).rjust(DENARY_MAX_LENGTH_DIGITS, ZERO_STRING), ENCODING)
-    socket.send(msg)
-    socket.sendall(bytes(serialised, encoding=ENCODING))
+    socket.sendall(jsonframe(data))
 
 def jsonrecv(socket: socket.socket) -> dict:
     "recieve one json packet over the given socket"
@@ -76,36 +79,6 @@ def jsonrecv(socket: socket.socket) -> dict:
         offset += recvSize
     return json.loads(view.tobytes())
 
-class Queue:
-    "thread safe queue (made of requests system)"
-    """
-    Thread-safe single-element-expanding queue. Queue with dequeue and enqueue.
-    Random access via __index__
-    """
-    def __init__(self):
-        self.list = []
-        self.lock = threading.Lock()
-        self.i = 0
-
-    def __index__(self, i) -> "untyped":
-        with self.lock:
-            return self.list[i]
-
-    def __repr__(self) -> str:
-        return "Q{}:{}".format(self.i, self.list)
-
-    def dequeue(self) -> "untyped":
-        with self.lock:
-            if self.i >= len(self.list):
-                return
-            element = self.list[self.i]
-            self.i += 1
-        return element
-
-    def enqueue(self, element: "untyped"):
-        with self.lock:
-            self.list.append(element)
-
 class Connection:
     """
     [09/12/17]
@@ -125,9 +98,13 @@ class Connection:
 
     def send(self, data: dict):
         "send json packet"
+        return self.send_frame(jsonframe(data))
+
+    def send_frame(self, frame: bytes) -> bool:
+        "send a packet already encoded by jsonframe"
         if self.closed:
             return False
-        jsonsend(self.conn, data)
+        self.conn.sendall(frame)
         return True
 
     def close(self):
@@ -197,10 +174,11 @@ class Server:
         self.accpThread = call(lambda: self.grab_clients())
 
     def send_all(self, data: dict):
-        "sends given json packet to every open Connection"
+        "sends given json packet to every open Connection, encoding it only once"
+        frame = jsonframe(data)
         with self.clientLock:
             for client in self.clients.values():
-                client.send(data)
+                client.send_frame(frame)
 
     def grab_clients(self):
         "constantly accept new clients and add them to the active client list"
@@ -265,40 +243,17 @@ def cli(sampler=0):
     c.close()
 
 
-serv()
-
-
-ls = []
-
-mt = call(serv)
-for i in range(4):
-    ls.append(call(lambda: cli(i)))
-
-for t in ls:
-    t.join()
-
-mt.join()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+if __name__ == "__main__":
+    serv()
 
 
+    ls = []
 
+    mt = call(serv)
+    for i in range(4):
+        ls.append(call(lambda: cli(i)))
 
+    for t in ls:
+        t.join()
 
+    mt.join()
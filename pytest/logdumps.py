@@ -30,7 +30,7 @@ class LogManager:
     def get_logs(self) -> list[LogTarget]:
         return list(self.logTargets.values())
 
-    def create_log(self, targets: set[str], timeStamper: Callable[None, str]=md,  defaultKwargs: dict={"flush": True}) -> Callable[..., None]:
+    def create_log(self, targets: set[str], timeStamper: Callable[[], str]=md,  defaultKwargs: dict={"flush": True}) -> Callable[..., None]:
         def internal(*args, **kwargs):
             kwargs = defaultKwargs | kwargs
             for logname in self.logTargets:
@@ -2,21 +2,67 @@
 
 """
 
+import asyncio
+import inspect
+import itertools
+import math
+import multiprocessing
+import os
 import socket as sockets
+import struct
 import threading
 import time
 import traceback
 import argh
+import msgpack
+from collections import deque
+from collections.abc import Callable, Iterator
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from dataclasses import asdict, astuple, dataclass, field
 
 import logdumps
-from pyservertools import call, msgsend, msgrecv, Queue, Convertable
-from pyserveconst import PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_FUNCTION_ID, PY_CONNECT_ARGS_ID, PY_CONNECT_RETURN, PY_CONNECT_ERROR
+from pyservertools import call, msgframe, msgparts, sendv, tune, amsgrecv, FrameReader, ShmListener, Convertable
+from pyservertools import Queue, QueueFull, Outbox, QUEUE_BLOCK, QUEUE_DROP, QUEUE_REJECT, Memo, Packed, DiskCache, Lanes
+from pyservertools import Budget
+from pyservemetrics import Registry
+from pyserveconst import PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_PATH, PY_CONNECT_SHM, PY_CONNECT_FUNCTION_ID, PY_CONNECT_ARGS_ID, PY_CONNECT_RETURN, PY_CONNECT_ERROR, PY_CONNECT_REQUEST_ID, PY_CONNECT_BATCH_ID, PY_CONNECT_ONEWAY_ID
+from pyserveconst import PY_CONNECT_STREAM_ID, PY_CONNECT_CHUNK, PY_CONNECT_END
+from pyserveconst import PY_CONNECT_TOPIC, PY_CONNECT_SUBSCRIBE, PY_CONNECT_UNSUBSCRIBE, PY_CONNECT_HANDSHAKE, PY_CONNECT_PROTOCOL
+from pyserveconst import PY_CONNECT_INVALIDATE, PY_CONNECT_PING, PY_CONNECT_DEADLINE_ID, PY_CONNECT_CANCEL_ID
+from pyserveconst import PY_CONNECT_PRIORITY_ID, PY_CONNECT_REALTIME, PY_CONNECT_INTERACTIVE, PY_CONNECT_BULK
+from pyserveconst import PY_CONNECT_STATS
+
+networklog = lambda *args, **kwargs: None # replaced with the real log when run as a script
+metricslog = lambda *args, **kwargs: None # likewise
 
 @dataclass(frozen=True)
 class Address(Convertable):
+    """
+    a TCP host and port. for same-host traffic, an AF_UNIX socket path when
+    path is set, or a shared memory rendezvous directory when shm is set
+    """
     addr: str=field(default="127.0.0.1")
     port: int=field(default=31775)
+    path: str=field(default="")
+    shm: str=field(default="")
+
+    def family(self) -> int:
+        return sockets.AF_UNIX if self.path else sockets.AF_INET
+
+    def sockaddr(self):
+        "what bind and connect take for this address"
+        return self.shm or self.path or (self.addr, self.port)
+
+@dataclass(frozen=True)
+class SocketOptions(Convertable):
+    "applied to every connection. buffer sizes of 0 keep the OS default"
+    nodelay: bool=field(default=True)
+    sndbuf: int=field(default=0)
+    rcvbuf: int=field(default=0)
+
+LAG_DROP = "drop"
+LAG_DISCONNECT = "disconnect"
 
 class Connection:
     """
@@ -24,47 +70,158 @@ class Connection:
     Represents a connection between client and a server. This
     is universal and used by both client and server to communicate
 
+    Nothing writes to the socket but the connection's own writer thread.
+    send and post queue frames in its outbox and the writer flushes
+    whatever has built up with as few sendmsg calls as it can. Broadcasts
+    are bounded so a slow client only holds up itself; once its outbox is
+    full lagPolicy either drops the oldest broadcast or disconnects it
+
+    Reading is bounded the same way. Each call read is queued as (addr,
+    frame, size) and counts against the connection's budget until it is
+    settled: by whoever answers it calling release once its replies are
+    queued, which settles it as the writer writes them, or by settle for
+    calls nobody replies to. While the budget is spent the reader stops
+    reading, so a client that sends without reading its replies is held
+    to maxPending of them. Frames a read brought in past the limits are held back until
+    there is room for them, so at most a read buffer's worth sit waiting
+
     self.conn: sockets.socket
     self.addr: Address
+    self.outbox: Outbox
+    self.budget: Budget # calls and bytes read but not yet answered
+    self.framesIn, self.bytesIn, self.framesOut, self.bytesOut: int # each only touched by its own thread
     """
-    def __init__(self, connect: "connection, ip", queue: Queue):
+    writeBatch = 64 # most frames gathered into one write
+
+    def __init__(self, connect: "connection, ip", queue: Queue, outboxSize: int=256, lagPolicy: str=LAG_DROP,
+                 maxPending: int=0, maxPendingBytes: int=0, admit: Callable=lambda addr, data: data,
+                 refused: Callable=lambda addr, data: None):
         self.closed = False
         self.conn, self.addr = connect
         self.queue = queue
+        self.admit, self.refused = admit, refused # see Server.admit
+        self.reader = FrameReader(self.conn)
+        self.outbox = Outbox(outboxSize, QUEUE_DROP if lagPolicy == LAG_DROP else QUEUE_REJECT)
+        self.budget = Budget(maxPending, maxPendingBytes)
+        self.held = deque() # (frame, size) read while the budget was spent
+        self.framesIn = self.bytesIn = self.framesOut = self.bytesOut = 0
 
     def __del__(self):
         self.close()
 
     def send(self, data: dict) -> bool:
-        "send json packet"
+        "queue packet as a reply. raises if msgpack can't encode it"
+        return self.send_frame(encode(data))
+
+    def send_frame(self, frame: tuple[bytes, bytes]) -> bool:
+        "send for a packet already encoded by msgparts. replies are never dropped"
         if self.closed:
             return False
-        msgsend(self.conn, data)
-        return True
+        return self.outbox.reply(frame)
+
+    def room(self) -> bool:
+        "waits for the writer to catch up before queueing another of many replies. False once closed"
+        return self.outbox.room()
+
+    def post(self, data: dict) -> bool:
+        "queues a broadcast packet. False if the client is gone or was just dropped for lagging"
+        return self.post_frame(msgparts(data))
+
+    def post_frame(self, frame: tuple[bytes, bytes]) -> bool:
+        "post for a packet already encoded by msgparts, which can be shared between connections"
+        if self.closed:
+            return False
+        try:
+            return self.outbox.post(frame)
+        except QueueFull:
+            networklog(f"disconnecting {self.addr}: outbox full")
+            self.close()
+            return False
+
+    def write_repeat(self):
+        "writes queued frames until the connection is closed. thread always writing"
+        while frames := self.outbox.take(self.writeBatch):
+            released = [frame for frame in frames if type(frame) is int] # see Outbox.release
+            parts = [part for frame in frames if type(frame) is not int for part in frame]
+            try:
+                if parts:
+                    sendv(self.conn, parts)
+            except OSError:
+                self.close()
+                return
+            self.framesOut += len(frames) - len(released)
+            self.bytesOut += sum(map(len, parts))
+            for size in released:
+                self.settle(size)
 
     def close(self):
         self.closed = True
+        self.outbox.close()
+        self.budget.close()
+        try:
+            self.conn.shutdown(sockets.SHUT_RDWR) # close alone waits for the blocked recv to tell the client
+        except OSError:
+            pass
         self.conn.close()
 
     def recv(self) -> bool:
         "returns success flag. data stored in the Connection's queue"
         if self.closed:
             return False
-        try:
-            data = msgrecv(self.conn)
-        except (ConnectionAbortedError, ConnectionResetError):
-            self.queue.enqueue((self.addr, None))
-            return False
-        if data is None:
-            self.queue.enqueue((self.addr, None))
-            return False
-        self.queue.enqueue((self.addr, data))
+        if not self.held:
+            try:
+                frames = self.reader.read()
+            except (OSError, ValueError): # ValueError covers malformed msgpack
+                frames = None
+            if frames is None:
+                try:
+                    self.queue.enqueue((self.addr, None))
+                except QueueFull: # the server is told straight away instead
+                    self.refused(self.addr, None)
+                return False
+            now = time.monotonic()
+            for data, size in zip(frames, self.reader.sizes):
+                data = self.admit(self.addr, stamp(data, now))
+                if data is not None:
+                    self.held.append((data, size))
+            self.framesIn += len(frames)
+            self.bytesIn += sum(self.reader.sizes)
+        while self.held and not self.budget.spent():
+            data, size = self.held.popleft()
+            self.budget.take(size)
+            try:
+                self.queue.enqueue((self.addr, data, size))
+            except QueueFull as e:
+                self.refuse(data, e)
+                self.refused(self.addr, data)
+                self.release(size)
         return True
 
+    def settle(self, size: int):
+        "gives back the budget a call of size bytes held, once it has been answered"
+        self.budget.give(size)
+
+    def release(self, size: int):
+        "settles a call once the replies queued for it so far have been written"
+        if not self.outbox.release(size):
+            self.settle(size) # closed. nothing will be written
+
+    def traffic(self) -> dict:
+        "what has gone through the connection, for the metrics"
+        return {"framesIn": self.framesIn, "bytesIn": self.bytesIn, "framesOut": self.framesOut,
+                "bytesOut": self.bytesOut, "pending": self.budget.calls, "pauses": self.budget.pauses}
+
+    def refuse(self, data, e: QueueFull):
+        "answers a call the queue turned away from here, rather than leaving it for the dispatch loop"
+        if type(data) is dict and not data.get(PY_CONNECT_ONEWAY_ID):
+            self.send(tag(error_packet(e), data.get(PY_CONNECT_REQUEST_ID)))
+        elif type(data) is list and len(data) > 1:
+            self.send(tag(error_packet(e), data[1]))
+
     def recv_repeat(self):
-        "recv but until connection closed. thread always listening"
+        "recv but until connection closed. thread always listening, unless the budget is spent"
         while True:
-            if not self.recv():
+            if not self.budget.wait() or not self.recv():
                 self.close()
                 return
 
@@ -73,20 +230,42 @@ class Server:
     Server that forms and controls connection and communication between
     itself and the client(s)
 
+    maxPending and maxPendingBytes are each connection's budget of calls
+    read but not yet answered (see Connection). 0 is unlimited. A subclass
+    answering calls has to settle each one, or its clients stall. For the
+    same reason queuePolicy can't be drop: a dropped call would never be
+    answered or settled, and dropping a disconnect would keep its client
+
     self.clients: dict
+    self.topics: dict # topic -> addresses of its subscribers
     self.socket: socket.socket
     """
-    def __init__(self, ip: Address, timeout: float=10.):
+    def __init__(self, ip: Address, timeout: float=10., queueCapacity: int=0, queuePolicy: str=QUEUE_BLOCK,
+                 outboxSize: int=256, lagPolicy: str=LAG_DROP, sockopts: SocketOptions=SocketOptions(),
+                 maxPending: int=1024, maxPendingBytes: int=16 << 20):
+        if queuePolicy == QUEUE_DROP:
+            raise ValueError("the server's queue can block or reject calls, not drop them")
         self.address = ip
-        self.socket = sockets.socket()
-        self.socket.bind(ip.astuple())
-        self.socket.listen()
+        self.sockopts = sockopts
+        if ip.shm:
+            self.socket = ShmListener(ip.shm)
+        else:
+            self.socket = sockets.socket(ip.family())
+            tune(self.socket, *sockopts.astuple()) # accepted sockets inherit the buffer sizes
+            if ip.path and os.path.exists(ip.path):
+                os.unlink(ip.path) # left behind by a server that didn't shut down cleanly
+            self.socket.bind(ip.sockaddr())
+            self.socket.listen()
         self.socket.settimeout(timeout)
         self.clientLock = threading.Lock()
         self.clients = {}
-        self.queue = Queue()
+        self.topics = {}
+        self.queue = Queue(queueCapacity, queuePolicy)
+        self.outboxSize, self.lagPolicy = outboxSize, lagPolicy
+        self.maxPending, self.maxPendingBytes = maxPending, maxPendingBytes
         self.accpThread = threading.Thread
         self.recvThreads = []
+        self.unixPeers = itertools.count() # AF_UNIX clients have no address of their own to key them by
 
     def __del__(self):
         try:
@@ -112,21 +291,74 @@ class Server:
         self.accpThread = call(lambda: self.grab_clients())
 
     def send_all(self, data: dict):
-        "sends given json packet to every open Connection"
+        "posts given packet to every open Connection, encoding it only once"
+        frame = msgparts(data)
+        with self.clientLock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.post_frame(frame)
+
+    def subscribe(self, addr: Address, topic: str):
+        with self.clientLock:
+            self.topics.setdefault(topic, set()).add(addr)
+
+    def unsubscribe(self, addr: Address, topic: str):
         with self.clientLock:
-            for client in self.clients.values():
-                client.send(data)
+            subscribers = self.topics.get(topic, set())
+            subscribers.discard(addr)
+            if not subscribers:
+                self.topics.pop(topic, None)
+
+    def publish(self, topic: str, data) -> int:
+        "posts data to every subscriber of topic and returns how many it was posted to"
+        frame = msgparts({PY_CONNECT_TOPIC: topic, PY_CONNECT_RETURN: data})
+        with self.clientLock:
+            clients = [self.clients[addr] for addr in self.topics.get(topic, ()) if addr in self.clients]
+        return sum(client.post_frame(frame) for client in clients)
+
+    def drop_client(self, addr: Address):
+        "forgets a client that has disconnected, along with its subscriptions"
+        with self.clientLock:
+            conn = self.clients.pop(addr, None)
+            for topic in [topic for topic, subscribers in self.topics.items() if addr in subscribers]:
+                self.topics[topic].discard(addr)
+                if not self.topics[topic]:
+                    del self.topics[topic]
+        if conn is not None:
+            conn.close()
+
+    def admit(self, addr: Address, data):
+        """
+        sees each frame on its connection's reader thread as it is read,
+        before it is queued. returns the frame to queue, or None if it has
+        been dealt with already
+        """
+        return data
+
+    def refused(self, addr: Address, data):
+        """
+        told about each frame admit passed that the queue then refused, and
+        with data None about a disconnect the queue had no room to pass on
+        """
+        if data is None:
+            self.drop_client(addr)
 
     def grab_clients(self):
         "constantly accept new clients and add them to the active client list"
         while True:
             try:
-                conn = Connection(self.socket.accept(), self.queue)
+                sock, addr = self.socket.accept()
+                if self.address.path and not self.address.shm:
+                    addr = (self.address.path, next(self.unixPeers))
+                conn = Connection((sock, addr), self.queue, self.outboxSize, self.lagPolicy,
+                                  self.maxPending, self.maxPendingBytes, self.admit, self.refused)
+                tune(conn.conn, *self.sockopts.astuple())
                 networklog("Found Client")
                 with self.clientLock:
                     self.clients[conn.addr] = conn
                 t = call(lambda: conn.recv_repeat())
                 self.recvThreads.append(t)
+                call(conn.write_repeat)
             except sockets.timeout:
                 pass
 
@@ -144,64 +376,879 @@ def tostring(d: bytes) -> str:
 def all_tostring(l: list[bytes]) -> list[str]:
     return [(str(d, encoding="utf-8") if (type(d) is bytes) else d) for d in l]
 
-class PyServer(Server):
-    def __init__(self, callMap={"print": print}):
-        super().__init__(Address(PY_CONNECT_ADDR, PY_CONNECT_PORT))
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
+# (queue depth, seconds the oldest call has waited) past which PyServer
+# refuses calls in each lane. see Lanes. realtime is limited too, as any
+# call can ask for it
+LANE_LIMITS = {
+    PY_CONNECT_REALTIME: (1024, .5),
+    PY_CONNECT_INTERACTIVE: (4096, 1.),
+    PY_CONNECT_BULK: (512, .25),
+}
+
+@dataclass(frozen=True)
+class Remote:
+    """
+    A callMap entry with its dispatch settings. Plain functions in a callMap
+    are treated as Remote(func).
+
+    executor:
+        inline  - run on the dispatching thread (default)
+        thread  - run on the shared thread pool, for I/O-bound handlers
+        process - run on the shared process pool, for CPU-bound handlers.
+                  func and its arguments must be picklable (no lambdas)
+    limit: most calls of this function running at once on its pool. 0 is
+        unlimited. Calls over the limit wait their turn without holding a
+        pool worker
+    cache: marks func as pure, memoising this many of its most recently
+        used results keyed on the packed arguments. A hit skips both the
+        call and packing the result. 0 doesn't memoise
+    ttl: seconds a memoised result stays fresh. 0 keeps it until evicted
+    disk: also keeps results in the Dispatcher's DiskCache, for expensive
+        functions whose results should survive a restart. Needs cache,
+        and no ttl, as rows on disk only go when evicted or invalidated
+    version: bump when func's results change, so the ones on disk from the
+        old version are thrown away rather than served
+    priority: lane its calls queue in on PyServer (see LANE_LIMITS) unless
+        a call asks for another. realtime, interactive or bulk
+
+    func may return an iterator (e.g. be a generator) to stream its result
+    to callers that ask for a stream; everyone else gets it as a list.
+    Iterators are drained on the thread pool whatever the executor, except
+    that process executor results can't be iterators at all
+    """
+    func: Callable
+    executor: str=field(default=INLINE)
+    limit: int=field(default=0)
+    cache: int=field(default=0)
+    ttl: float=field(default=0.)
+    disk: bool=field(default=False)
+    version: int=field(default=0)
+    priority: str=field(default=PY_CONNECT_INTERACTIVE)
+
+    def __post_init__(self):
+        if self.executor not in (INLINE, THREAD, PROCESS):
+            raise ValueError(f"unknown executor {self.executor}")
+        if self.priority not in LANE_LIMITS:
+            raise ValueError(f"unknown priority {self.priority}")
+        if self.cache < 0 or self.ttl < 0:
+            raise ValueError("cache and ttl can't be negative")
+        if self.disk and not self.cache:
+            raise ValueError("disk caching sits behind the memo, so needs cache")
+        if self.disk and self.ttl:
+            raise ValueError("results on disk never expire, so disk can't have a ttl")
+
+class Expired(Exception):
+    "stands in for the result of a call its caller cancelled or stopped waiting for"
+
+class Ticket:
+    """
+    Whether a call is still wanted: the monotonic time it is due by, if its
+    caller sent a deadline (see stamp), and whether the caller has since
+    cancelled it. Expired calls are dropped rather than run if they haven't
+    started, and their results are thrown away if they have
+    """
+    __slots__ = ("due", "cancelled")
+
+    def __init__(self, due: float=None):
+        self.due = due
+        self.cancelled = False
+
+    def expired(self) -> bool:
+        return self.cancelled or (self.due is not None and time.monotonic() > self.due)
+
+    def failure(self) -> dict:
+        "the error packet answering the call instead"
+        return error_packet(Expired("cancelled by the caller" if self.cancelled else "deadline passed"))
+
+class Dispatcher:
+    """
+    Resolves call packets against a callMap and runs them on the executor
+    each entry asks for. Shared by PyServer and AsyncPyServer so both speak
+    the same protocol.
+
+    Calls are either a packet naming the function or, once a client has
+    called the reserved __handshake__ function for the callMap's ids, a
+    positional [id, reqid, args] frame
+
+    Each function's calls, errors and latency (until its result is ready,
+    or its iterator is, for streams) go in self.metrics, which the
+    reserved __stats__ call reads
+
+    self.calls: dict
+    self.names: list # function id -> name
+    self.memos: dict # function name -> Memo, for functions marked cacheable
+    self.diskCache: DiskCache # shared by the functions marked disk, if any
+    self.active: dict # function name -> calls running on a pool
+    self.backlog: dict # function name -> calls waiting on its limit
+    self.tickets: dict # (client, request id) -> Ticket of each call not yet answered
+    self.metrics: Registry
+    self.callMetrics: dict # function name -> its (calls, errors, latency) metrics
+    """
+    def __init__(self, callMap: dict, threads: int=8, processes: int=None, chunkItems: int=64,
+                 diskCache: DiskCache=None):
         self.calls = callMap
+        self.names = list(callMap)
+        self.memos = {name: Memo(entry.cache, entry.ttl) for name, entry in callMap.items()
+                      if isinstance(entry, Remote) and entry.cache}
+        self.diskCache = diskCache
+        for name, entry in callMap.items():
+            if isinstance(entry, Remote) and entry.disk:
+                if diskCache is None:
+                    raise ValueError(f"{name} is marked disk but there is no diskCache")
+                diskCache.invalidate(name, entry.version) # older versions' results are dead weight
+        self.chunkItems = chunkItems
+        self.threadPool = ThreadPoolExecutor(threads)
+        self.processPool = ProcessPoolExecutor(processes)
+        self.limitLock = threading.Lock()
+        self.active = {}
+        self.backlog = {}
+        self.tickets = {}
+        self.metrics = Registry()
+        self.callMetrics = {}
+        if self.memos:
+            self.metrics.gauge("cache", self.cache_stats)
+
+    def remote(self, func: str) -> Remote:
+        if func == PY_CONNECT_HANDSHAKE:
+            return Remote(self.handshake)
+        if func == PY_CONNECT_PING:
+            return Remote(ping)
+        if func == PY_CONNECT_STATS:
+            return Remote(self.metrics.read)
+        entry = self.calls[func]
+        return entry if isinstance(entry, Remote) else Remote(entry)
+
+    def handshake(self) -> list:
+        """
+        [protocol version, [name, id, arity, cache] for every function in
+        the callMap]. see arity. cache is -1 if clients mustn't cache the
+        function's results, otherwise how many seconds they stay fresh, 0
+        for until the server invalidates them
+        """
+        functions = []
+        for funcId, name in enumerate(self.names):
+            remote = self.remote(name)
+            functions.append([name, funcId, arity(remote.func), remote.ttl if remote.cache else -1])
+        return [PY_CONNECT_PROTOCOL, functions]
+
+    def expand(self, frame: list) -> dict:
+        "the call packet a positional [id, reqid, args] frame stands for"
+        try:
+            funcId, reqid, args, *due = frame
+            if len(due) > 1:
+                raise ValueError
+        except (TypeError, ValueError):
+            return {PY_CONNECT_FUNCTION_ID: None, PY_CONNECT_ARGS_ID: ()}
+        known = type(funcId) is int and 0 <= funcId < len(self.names)
+        data = {PY_CONNECT_FUNCTION_ID: self.names[funcId] if known else funcId, PY_CONNECT_ARGS_ID: args}
+        if due and due[0] is not None:
+            data[PY_CONNECT_DEADLINE_ID] = due[0]
+        return tag(data, reqid)
+
+    def resolve(self, data: dict) -> tuple[str, list]:
+        "pulls the function name and arguments out of a call packet"
+        try:
+            return data[PY_CONNECT_FUNCTION_ID], data[PY_CONNECT_ARGS_ID]
+        except KeyError:
+            if tobytes(PY_CONNECT_FUNCTION_ID) not in data:
+                raise
+        # clients from before protocol 2 packed every string as bin
+        return tostring(data[tobytes(PY_CONNECT_FUNCTION_ID)]), all_tostring(data[tobytes(PY_CONNECT_ARGS_ID)])
+
+    def lane(self, element: tuple) -> str:
+        """
+        the priority lane of a queued (addr, frame): the one the call asks
+        for, or else its function's. reserved calls and disconnects go in
+        realtime, as they are cheap and free up the rest. cancels never get
+        here, as admit handles them as they are read
+        """
+        data = element[1]
+        if type(data) is dict:
+            if type(data.get(PY_CONNECT_PRIORITY_ID)) is str: # anything else gets the function's lane
+                return data[PY_CONNECT_PRIORITY_ID]
+            func = data.get(PY_CONNECT_FUNCTION_ID)
+        elif type(data) is list and data:
+            known = type(data[0]) is int and 0 <= data[0] < len(self.names)
+            func = self.names[data[0]] if known else None
+        else:
+            return PY_CONNECT_REALTIME
+        if func in RESERVED:
+            return PY_CONNECT_REALTIME
+        entry = self.calls.get(func) if type(func) is str else None
+        return entry.priority if isinstance(entry, Remote) else PY_CONNECT_INTERACTIVE
+
+    def ticket(self, addr, data: dict) -> "Ticket":
+        "the Ticket for a call, made the first time it is asked for and kept until it is answered so a cancel frame can find it"
+        reqid = data.get(PY_CONNECT_REQUEST_ID)
+        if type(reqid) is not int:
+            return Ticket(data.get(PY_CONNECT_DEADLINE_ID))
+        ticket = self.tickets.get((addr, reqid))
+        if ticket is None:
+            ticket = self.tickets[addr, reqid] = Ticket(data.get(PY_CONNECT_DEADLINE_ID))
+        return ticket
+
+    def answered(self, addr, reqid: int):
+        "forgets the ticket of a call once its answer is sent"
+        if type(reqid) is int:
+            self.tickets.pop((addr, reqid), None)
+
+    def abandon(self, addr):
+        "cancels the calls of a client that has disconnected, as nobody is left to answer"
+        for key in [key for key in list(self.tickets) if key[0] == addr]:
+            ticket = self.tickets.pop(key, None)
+            if ticket is not None:
+                ticket.cancelled = True
+
+    def cancel(self, addr, reqid: int):
+        "handles a cancel frame: the call is dropped if it hasn't started and its result thrown away if it has"
+        ticket = self.tickets.get((addr, reqid)) if type(reqid) is int else None
+        if ticket is not None: # otherwise it has already been answered
+            ticket.cancelled = True
+
+    def submit(self, data: dict, ticket: "Ticket"=None) -> Future:
+        "starts the call described by data. the future resolves to the response packet"
+        if PY_CONNECT_BATCH_ID in data:
+            return self.submit_batch(data[PY_CONNECT_BATCH_ID], ticket)
+        try:
+            func, args = self.resolve(data)
+            remote = self.remote(func)
+        except (KeyError, TypeError) as e:
+            self.metrics.counter("calls.unresolved").inc()
+            return resolved(error_packet(e))
+        start = time.perf_counter()
+        if remote.cache:
+            future = self.submit_cached(func, remote, args, ticket)
+        else:
+            future = self.run(func, remote, args, ticket)
+        future.add_done_callback(lambda done: self.measure(func, start, done.result()))
+        return future
+
+    def measure(self, func: str, start: float, resp: dict):
+        "records a call of func that started at start (perf_counter) and finished with resp"
+        metrics = self.callMetrics.get(func)
+        if metrics is None:
+            metrics = self.callMetrics[func] = (self.metrics.counter(f"calls.{func}.count"),
+                                                self.metrics.counter(f"calls.{func}.errors"),
+                                                self.metrics.histogram(f"calls.{func}.latency"))
+        calls, errors, latency = metrics
+        calls.inc()
+        if PY_CONNECT_ERROR in resp:
+            errors.inc()
+        latency.observe(time.perf_counter() - start)
+
+    def run(self, func: str, remote: Remote, args: list, ticket: "Ticket"=None) -> Future:
+        "calls func on its executor, unless the call has already expired. the future resolves to the response packet"
+        if ticket is not None and ticket.expired():
+            return resolved(ticket.failure())
+        future = Future()
+        if remote.executor == INLINE:
+            try:
+                future.set_result({PY_CONNECT_RETURN: remote.func(*args)})
+            except Exception as e:
+                future.set_result(error_packet(e))
+            return future
+        with self.limitLock:
+            if remote.limit and self.active.get(func, 0) >= remote.limit:
+                self.backlog.setdefault(func, deque()).append((remote, args, future, ticket))
+                return future
+            self.active[func] = self.active.get(func, 0) + 1
+        self.launch(func, remote, args, future, ticket)
+        return future
+
+    def submit_cached(self, func: str, remote: Remote, args: list, ticket: "Ticket"=None) -> Future:
+        "answers a pure function's call from its memo, running it and memoising the result on a miss"
+        memo = self.memos[func]
+        key = msgpack.dumps(args, use_bin_type=True)
+        hit = memo.get(key)
+        if hit is None and remote.disk:
+            raw = self.diskCache.get(func, remote.version, key)
+            if raw is not None:
+                hit = Packed(msgpack.loads(raw, raw=False), raw)
+                memo.put(key, hit)
+        if hit is not None:
+            return resolved({PY_CONNECT_RETURN: hit})
+        future = Future()
+        self.run(func, remote, args, ticket).add_done_callback(lambda done: future.set_result(self.memoise(func, remote, key, done.result())))
+        return future
+
+    def memoise(self, func: str, remote: Remote, key: bytes, resp: dict) -> dict:
+        "stores a successful response's return value, packed, and gives back the packet to send"
+        out = resp.get(PY_CONNECT_RETURN)
+        if PY_CONNECT_ERROR in resp or isinstance(out, Iterator):
+            return resp
+        try:
+            packed = Packed(out, msgpack.dumps(out, use_bin_type=True))
+        except (TypeError, ValueError, OverflowError): # respond reports these
+            return resp
+        self.memos[func].put(key, packed)
+        if remote.disk:
+            self.diskCache.put(func, remote.version, key, packed.raw)
+        return {PY_CONNECT_RETURN: packed}
+
+    def forget(self, func: str, args: list=None):
+        "drops func's cached results for args, or all of them if args is None, from memory and disk"
+        key = None if args is None else msgpack.dumps(list(args), use_bin_type=True)
+        memo = self.memos.get(func)
+        if memo is not None and key is None:
+            memo.clear()
+        elif memo is not None:
+            memo.discard(key)
+        if self.remote(func).disk:
+            self.diskCache.discard(func, key)
+
+    def cache_stats(self) -> dict:
+        "size, hits, misses and evictions of each cacheable function's memo. the disk tier's are under diskCache.stats"
+        return {name: memo.stats() for name, memo in self.memos.items()}
+
+    def submit_batch(self, entries: list, ticket: "Ticket"=None) -> Future:
+        """
+        starts every [function, args] entry of a batch frame in one pass. the
+        future resolves to a response packet whose return value is the list
+        of each entry's own response packet, in order
+        """
+        if type(entries) is not list:
+            return resolved(error_packet(TypeError("a batch is a list of [function, args] entries")))
+        futures = []
+        for entry in entries:
+            try:
+                func, args = entry
+            except (TypeError, ValueError) as e:
+                futures.append(resolved(error_packet(e)))
+                continue
+            futures.append(self.submit({PY_CONNECT_FUNCTION_ID: func, PY_CONNECT_ARGS_ID: args}, ticket))
+        future = Future()
+        def combine(results: Future):
+            entries = [packed_entry(resp) for resp in results.result()]
+            raw = msgpack.Packer().pack_array_header(len(entries)) + b"".join(entry.raw for entry in entries)
+            future.set_result({PY_CONNECT_RETURN: Packed([entry.value for entry in entries], raw)})
+        gather(futures).add_done_callback(combine)
+        return future
+
+    def packets(self, data: dict, resp: dict, ticket: "Ticket"=None) -> Iterator[dict]:
+        """
+        the packets answering the call in data. normally just resp; an
+        iterator result is streamed as chunk packets and an end marker if
+        the call asked for a stream, or sent whole as a list if not. once
+        the call has expired the rest is swapped for the ticket's failure
+        """
+        reqid = data.get(PY_CONNECT_REQUEST_ID)
+        out = resp.get(PY_CONNECT_RETURN)
+        if ticket is not None and ticket.expired():
+            resp = ticket.failure()
+            out = None
+        if not isinstance(out, Iterator):
+            yield tag(resp, reqid)
+            return
+        if ticket is not None:
+            out = itertools.takewhile(lambda _: not ticket.expired(), out) # stops drawing on it once expired
+        try:
+            if data.get(PY_CONNECT_STREAM_ID):
+                while chunk := list(islice(out, self.chunkItems)):
+                    yield tag({PY_CONNECT_CHUNK: chunk}, reqid)
+                last = {PY_CONNECT_END: True}
+            else:
+                last = {PY_CONNECT_RETURN: list(out)}
+        except Exception as e:
+            last = error_packet(e)
+        if ticket is not None and ticket.expired():
+            last = ticket.failure()
+        yield tag(last, reqid)
+
+    def launch(self, func: str, remote: Remote, args: list, future: Future, ticket: "Ticket"=None):
+        try:
+            if remote.executor == THREAD and ticket is not None:
+                work = self.threadPool.submit(guarded, ticket, remote.func, *args)
+            elif remote.executor == THREAD:
+                work = self.threadPool.submit(remote.func, *args)
+            else:
+                work = self.processPool.submit(remote.func, *args)
+        except Exception as e: # unpicklable arguments, pool shut down
+            future.set_result(error_packet(e))
+            self.finished(func)
+            return
+        work.add_done_callback(lambda work: self.complete(func, work, future))
+
+    def complete(self, func: str, work: Future, future: Future):
+        try:
+            future.set_result({PY_CONNECT_RETURN: work.result()})
+        except Exception as e:
+            future.set_result(error_packet(e))
+        self.finished(func)
+
+    def finished(self, func: str):
+        "frees func's slot on its pool, handing it to the next waiting call that hasn't expired"
+        expired, launch = [], None
+        with self.limitLock:
+            waiting = self.backlog.get(func)
+            while waiting and launch is None:
+                entry = waiting.popleft()
+                ticket = entry[3]
+                if ticket is not None and ticket.expired():
+                    expired.append(entry)
+                else:
+                    launch = entry
+            if launch is None:
+                self.active[func] -= 1
+        for _, _, future, ticket in expired:
+            future.set_result(ticket.failure())
+        if launch is not None:
+            self.launch(func, *launch)
+
+RESERVED = (PY_CONNECT_SUBSCRIBE, PY_CONNECT_UNSUBSCRIBE, PY_CONNECT_HANDSHAKE, PY_CONNECT_PING, PY_CONNECT_STATS)
+
+def ping():
+    "answers the reserved __ping__ call clients health check their connections with"
+
+def arity(func: Callable) -> int:
+    "the most positional arguments func takes, or -1 for any number (or if python can't tell)"
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError): # some builtins
+        return -1
+    if any(param.kind == param.VAR_POSITIONAL for param in params):
+        return -1
+    return sum(param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD) for param in params)
+
+def unpacked(resp: dict) -> dict:
+    "resp with a Packed return value swapped back for the value, for when it's sent inside another packet"
+    out = resp.get(PY_CONNECT_RETURN)
+    return {PY_CONNECT_RETURN: out.value} if type(out) is Packed else resp
+
+def packed_entry(resp: dict) -> Packed:
+    """
+    resp packed on its own to go in a batch's response. an iterator result
+    is drained to a list, and a result msgpack can't encode becomes this
+    entry's error rather than failing the whole batch
+    """
+    if isinstance(resp.get(PY_CONNECT_RETURN), Iterator):
+        try:
+            resp = {PY_CONNECT_RETURN: list(resp[PY_CONNECT_RETURN])}
+        except Exception as e:
+            resp = error_packet(e)
+    try:
+        raw = encode(resp)[1]
+    except (TypeError, ValueError, OverflowError) as e:
+        resp = error_packet(e)
+        raw = msgpack.dumps(resp, use_bin_type=True)
+    return Packed(unpacked(resp), raw)
+
+def encode(packet: dict) -> tuple[bytes, bytes]:
+    "msgparts, except a Packed return value is spliced in as its bytes rather than packed again"
+    out = packet.get(PY_CONNECT_RETURN)
+    if type(out) is not Packed:
+        return msgparts(packet)
+    packer = msgpack.Packer(use_bin_type=True)
+    body = [packer.pack_map_header(len(packet)), packer.pack(PY_CONNECT_RETURN), out.raw]
+    for key, value in packet.items():
+        if key != PY_CONNECT_RETURN:
+            body += [packer.pack(key), packer.pack(value)]
+    body = b"".join(body)
+    return struct.pack(">L", len(body)), body
+
+def resolved(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def gather(futures: list[Future]) -> Future:
+    "future resolving to the list of results of futures once they have all finished"
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        combined.set_result([future.result() for future in futures])
+    if not futures:
+        combined.set_result([])
+    for future in futures:
+        future.add_done_callback(finished)
+    return combined
+
+def stamp(data, now: float):
+    """
+    swaps the seconds a call's caller will wait for the monotonic time it is
+    due by, as the call arrives. budgets rather than times go over the wire
+    so the two ends' clocks needn't agree
+    """
+    if type(data) is dict:
+        if PY_CONNECT_DEADLINE_ID in data:
+            budget = data.pop(PY_CONNECT_DEADLINE_ID)
+            if isinstance(budget, (int, float)): # anything else is ignored rather than compared later
+                data[PY_CONNECT_DEADLINE_ID] = now + budget
+    elif type(data) is list and len(data) == 4:
+        data[3] = now + data[3] if isinstance(data[3], (int, float)) else None
+    return data
+
+def guarded(ticket: Ticket, func: Callable, *args):
+    "runs func(*args) on a pool worker, unless the call expired while it sat in the pool's queue"
+    if ticket.expired():
+        raise Expired("cancelled by the caller" if ticket.cancelled else "deadline passed")
+    return func(*args)
+
+def error_packet(e: Exception) -> dict:
+    return {PY_CONNECT_ERROR: f"{type(e).__name__}: {e}"}
+
+def log_failure(future: Future):
+    "done callback for one-way calls, which have nobody to report errors to"
+    resp = future.result()
+    if PY_CONNECT_ERROR in resp:
+        networklog("one-way call failed:", resp[PY_CONNECT_ERROR])
+
+def tag(resp: dict, reqid: int) -> dict:
+    "stamps a response with the request id of the call it answers, if it had one"
+    if reqid is not None:
+        resp[PY_CONNECT_REQUEST_ID] = reqid
+    return resp
+
+class PyServer(Server, Dispatcher):
+    """
+    Server dispatching calls off the queue its connections' reader threads
+    fill. With lanes (LANE_LIMITS by default) the queue is split into
+    priority lanes with admission limits, so a burst of bulk calls is
+    refused with an Overloaded error up front instead of queueing ahead of
+    frame-critical ones. lanes=None keeps the plain FIFO Queue set up by
+    queueCapacity and queuePolicy.
+
+    Within a lane each client's calls are queued apart and taken in turn
+    (see Fair), so one client flooding the server only slows itself down.
+    weights gives clients a bigger or smaller share, keyed by their address
+    or just its host: {"10.0.0.5": 2} takes two of that client's calls for
+    every one of a client left at the default of 1
+
+    Besides the Dispatcher's metrics it keeps the connection count, the
+    queue's depth, how long calls waited in it (with lanes) and how many
+    each lane refused, and each client's traffic
+
+    self.weights: dict # address or host -> share of its lanes a client gets
+    """
+    def __init__(self, callMap={"print": print}, threads: int=8, processes: int=None, chunkItems: int=64,
+                 ip: Address=None, diskCache: DiskCache=None, lanes: dict=LANE_LIMITS, weights: dict=None,
+                 **serverOptions):
+        Server.__init__(self, ip or Address(PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_PATH, PY_CONNECT_SHM), **serverOptions)
+        Dispatcher.__init__(self, callMap, threads, processes, chunkItems, diskCache)
+        self.weights = weights or {}
+        if any(weight <= 0 for weight in self.weights.values()):
+            raise ValueError("client weights must be positive")
+        if lanes:
+            self.queue = Lanes(self.lane, lanes, owner=lambda element: element[0], weigh=self.weight,
+                               observe=self.metrics.histogram("queue.wait").observe)
+            self.metrics.gauge("queue.refused", lambda: dict(self.queue.refused))
+        self.metrics.gauge("queue.depth", lambda: len(self.queue))
+        self.metrics.gauge("connections", lambda: len(self.clients))
+        self.metrics.gauge("clients", self.traffic)
+
+    def traffic(self) -> dict:
+        "each connected client's Connection.traffic, by address"
+        with self.clientLock:
+            clients = list(self.clients.items())
+        return {":".join(map(str, addr[:2])): client.traffic() for addr, client in clients}
+
+    def weight(self, addr: Address) -> float:
+        "the share of each lane the client at addr gets"
+        weight = self.weights.get(addr)
+        return weight if weight is not None else self.weights.get(addr[0], 1.)
+
+    def invalidate(self, func: str, *args):
+        """
+        call when the state behind a cacheable function changes. drops the
+        results cached for func(*args), or for every call of func if no args
+        are given, here and in every connected client's cache
+        """
+        args = list(args) if args else None
+        self.forget(func, args)
+        frame = msgparts({PY_CONNECT_INVALIDATE: [func, args]})
+        with self.clientLock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.send_frame(frame) # as a reply, so a lagging client can't drop it and serve stale results
 
-    def handle_request(self, addr: Address, data: dict) -> bool:
+    def handle_request(self, addr: Address, data: dict, size: int=None) -> bool:
+        "size is what the call counts against its connection's budget, settled once it's answered"
         networklog("handling a request")
         networklog(addr, data)
         if data is None:
+            self.drop_client(addr)
+            self.abandon(addr)
+            return False
+        if addr not in self.clients: # disconnects are realtime, so can overtake a client's last calls
             return False
-        if PY_CONNECT_FUNCTION_ID in data:
-            resp = self.call_noconv(data[PY_CONNECT_FUNCTION_ID], data[PY_CONNECT_ARGS_ID])
+        try:
+            return self.dispatch(addr, data, size)
+        except Exception as e: # a malformed frame is answered with the error rather than stopping operate
+            networklog("bad request from", addr, e)
+            data = data if type(data) is dict else {}
+            self.respond(addr, data, error_packet(e), size=size)
+            self.answered(addr, data.get(PY_CONNECT_REQUEST_ID))
+            return False
+
+    def admit(self, addr: Address, data):
+        """
+        cancels are handled as they are read, and every other call that
+        will be answered gets its Ticket then, so a cancel reaches a call
+        still waiting in the queue. positional frames are expanded here too
+        """
+        if type(data) is list:
+            data = self.expand(data)
+        if type(data) is not dict:
+            return data # handle_request answers it with the error
+        if PY_CONNECT_CANCEL_ID in data:
+            self.cancel(addr, data[PY_CONNECT_CANCEL_ID])
+            return None
+        if not data.get(PY_CONNECT_ONEWAY_ID):
+            self.ticket(addr, data)
+        return data
+
+    def refused(self, addr: Address, data):
+        Server.refused(self, addr, data)
+        if data is None:
+            self.abandon(addr)
+        elif type(data) is dict:
+            self.answered(addr, data.get(PY_CONNECT_REQUEST_ID))
+
+    def dispatch(self, addr: Address, data: dict, size: int=None) -> bool:
+        "starts the call in a frame from a connected client"
+        if type(data) is list:
+            data = self.expand(data)
+        if data.get(PY_CONNECT_FUNCTION_ID) in (PY_CONNECT_SUBSCRIBE, PY_CONNECT_UNSUBSCRIBE):
+            self.respond(addr, data, self.subscription(addr, data), size=size)
+            self.answered(addr, data.get(PY_CONNECT_REQUEST_ID))
+            return True
+        if data.get(PY_CONNECT_ONEWAY_ID):
+            future = self.submit(data, Ticket(data.get(PY_CONNECT_DEADLINE_ID)))
+            future.add_done_callback(log_failure)
+            future.add_done_callback(lambda _: self.settle(addr, size))
+            return True
+        ticket = self.ticket(addr, data)
+        self.submit(data, ticket).add_done_callback(lambda future: self.answer(addr, data, future.result(), ticket, size))
+        return True
+
+    def settle(self, addr: Address, size: int):
+        "gives back the budget a call held on its connection, if the call was counted"
+        if size is None:
+            return
+        with self.clientLock:
+            client = self.clients.get(addr)
+        if client is not None:
+            client.settle(size)
+
+    def subscription(self, addr: Address, data: dict) -> dict:
+        "handles the reserved (un)subscribe calls, which act on the caller's own subscriptions"
+        change = self.subscribe if data[PY_CONNECT_FUNCTION_ID] == PY_CONNECT_SUBSCRIBE else self.unsubscribe
+        try:
+            for topic in data[PY_CONNECT_ARGS_ID]:
+                change(addr, topic)
+        except TypeError as e: # unhashable topic
+            return error_packet(e)
+        return {PY_CONNECT_RETURN: None}
+
+    def answer(self, addr: Address, data: dict, resp: dict, ticket: Ticket=None, size: int=None):
+        "responds to data, draining iterator results on the thread pool rather than here"
+        if isinstance(resp.get(PY_CONNECT_RETURN), Iterator):
+            self.threadPool.submit(self.respond, addr, data, resp, ticket, size)
         else:
-            resp = self.call(data[tobytes(PY_CONNECT_FUNCTION_ID)], data[tobytes(PY_CONNECT_ARGS_ID)])
-        
-        #resp = {PY_CONNECT_ERROR: True}
-        self.clients[addr].send(resp)
+            self.respond(addr, data, resp, ticket, size)
+
+    def respond(self, addr: Address, data: dict, resp: dict, ticket: Ticket=None, size: int=None):
+        "sends the answer to data to the client at addr for as long as it stays connected"
+        reqid = data.get(PY_CONNECT_REQUEST_ID)
+        with self.clientLock:
+            client = self.clients.get(addr)
+        try:
+            if client is None:
+                return
+            streaming = isinstance(resp.get(PY_CONNECT_RETURN), Iterator)
+            for packet in self.packets(data, resp, ticket):
+                if streaming and not client.room(): # holds the stream to the client's pace
+                    return
+                try:
+                    sent = client.send(packet)
+                except (TypeError, ValueError, OverflowError) as e: # result msgpack can't encode
+                    sent = client.send(tag(error_packet(e), reqid))
+                if not sent:
+                    return
+        finally:
+            if ticket is not None:
+                self.answered(addr, reqid)
+            if client is not None and size is not None:
+                client.release(size)
 
     def operate(self):
         while True:
-            data = self.queue.dequeue()
-            if data:
-                networklog("handling a request")
-                self.handle_request(*data)
+            data = self.queue.dequeue(timeout=None)
+            networklog("handling a request")
+            self.handle_request(*data)
 
-    def call(self, func: str, args: list) -> dict:
-        out = self.calls[tostring(func)](*all_tostring(args))
-        return {PY_CONNECT_RETURN: out}
+class AsyncPyServer(Dispatcher):
+    """
+    asyncio version of PyServer. Each client is a coroutine reading frames
+    off its StreamReader rather than a recv thread feeding a shared Queue,
+    so an idle server sits in the event loop instead of polling.
+    Calls carrying a request id are answered as they finish, in any order;
+    calls without one are answered in the order they arrived. One-way calls
+    are run but never answered. The event loop can only wait on sockets, so
+    there is no shared memory transport here; use PyServer for that.
+    A client stops being read while maxPending of its calls are unanswered
+    (0 is unlimited); frames are read one at a time, so that bounds its bytes too
 
-    def call_noconv(self, func: str, args: list) -> dict:
-        out = self.calls[func](*args)
-        return {PY_CONNECT_RETURN: out}
+    self.clients: dict
+    """
+    def __init__(self, callMap={"print": print}, ip: Address=Address(PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_PATH),
+                 threads: int=8, processes: int=None, chunkItems: int=64, diskCache: DiskCache=None,
+                 maxPending: int=1024):
+        if ip.shm:
+            raise ValueError("AsyncPyServer has no shared memory transport")
+        super().__init__(callMap, threads, processes, chunkItems, diskCache)
+        self.address = ip
+        self.maxPending = maxPending
+        self.clients = {}
+        self.metrics.gauge("connections", lambda: len(self.clients))
+        self.unixPeers = itertools.count()
 
+    def __repr__(self) -> str:
+        return f"AsyncPyServer at {self.address} has ({len(self.clients)} clients"
 
-def test_server():
-    calls = {
+    def operate(self):
+        "runs the server until interrupted"
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        if self.address.path:
+            if os.path.exists(self.address.path):
+                os.unlink(self.address.path)
+            server = await asyncio.start_unix_server(self.handle_client, self.address.path)
+        else:
+            server = await asyncio.start_server(self.handle_client, self.address.addr, self.address.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        "reads and answers frames from one client until it disconnects"
+        addr = writer.get_extra_info("peername")
+        if self.address.path:
+            addr = (self.address.path, next(self.unixPeers)) # AF_UNIX peers are all unnamed
+        networklog("Found Client")
+        self.clients[addr] = writer
+        writeLock = asyncio.Lock()
+        pending = set()
+        room = asyncio.Semaphore(self.maxPending or 1)
+        try:
+            while True:
+                data = await amsgrecv(reader)
+                if data is None:
+                    return
+                networklog(addr, data)
+                data = stamp(data, time.monotonic())
+                if type(data) is list:
+                    data = self.expand(data)
+                if PY_CONNECT_CANCEL_ID in data:
+                    self.cancel(addr, data[PY_CONNECT_CANCEL_ID])
+                elif data.get(PY_CONNECT_ONEWAY_ID):
+                    self.submit(data, Ticket(data.get(PY_CONNECT_DEADLINE_ID))).add_done_callback(log_failure)
+                elif PY_CONNECT_REQUEST_ID in data:
+                    if self.maxPending:
+                        await room.acquire() # stops reading until one of this client's calls is answered
+                    task = asyncio.create_task(self.answer(writer, writeLock, data, self.ticket(addr, data)))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    if self.maxPending:
+                        task.add_done_callback(lambda _: room.release())
+                    task.add_done_callback(lambda _, reqid=data[PY_CONNECT_REQUEST_ID]: self.answered(addr, reqid))
+                else:
+                    await self.answer(writer, writeLock, data, Ticket(data.get(PY_CONNECT_DEADLINE_ID)))
+        except ConnectionError:
+            pass
+        finally:
+            del self.clients[addr]
+            self.abandon(addr)
+            writer.close()
+
+    async def answer(self, writer: asyncio.StreamWriter, writeLock: asyncio.Lock, data: dict, ticket: Ticket):
+        "runs one call and writes its response"
+        resp = await asyncio.wrap_future(self.submit(data, ticket))
+        packets = self.packets(data, resp, ticket)
+        streaming = isinstance(resp.get(PY_CONNECT_RETURN), Iterator)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if streaming:
+                    packet = await loop.run_in_executor(self.threadPool, next, packets, None)
+                else:
+                    packet = next(packets, None)
+                if packet is None:
+                    return
+                try:
+                    frame = b"".join(encode(packet))
+                except (TypeError, ValueError, OverflowError) as e: # result msgpack can't encode
+                    frame = msgframe(tag(error_packet(e), data.get(PY_CONNECT_REQUEST_ID)))
+                async with writeLock:
+                    writer.write(frame)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def count_primes(n: int) -> int:
+    "deliberately slow CPU-bound call for trying out the process pool"
+    return sum(all(i % d for d in range(2, math.isqrt(i) + 1)) for i in range(2, n))
+
+def test_calls() -> dict:
+    return {
         "hello": lambda: "hello friend",
         "goodbye": lambda x: f"goodbye {x}",
-        "add": lambda x, y: x + y,
-        "echo": lambda x: networklog(f"said {x}")
+        "add": Remote(lambda x, y: x + y, cache=1024),
+        "echo": lambda x: networklog(f"said {x}"),
+        "count": lambda n: iter(range(n)),
+        "sleep": Remote(time.sleep, THREAD, limit=4),
+        "primes": Remote(count_primes, PROCESS, cache=64, ttl=60., priority=PY_CONNECT_BULK)
     }
-    server = PyServer(callMap=calls)
+
+def disk_calls(cache: str) -> tuple[dict, DiskCache]:
+    "test_calls, keeping primes results in a DiskCache at cache if it's given"
+    calls = test_calls()
+    if not cache:
+        return calls, None
+    calls["primes"] = Remote(count_primes, PROCESS, cache=64, disk=True, priority=PY_CONNECT_BULK)
+    return calls, DiskCache(cache)
+
+def test_server(cache: str="", stats: float=60.):
+    "stats is how often, in seconds, the metrics are dumped to the metricslog. 0 never does"
+    calls, diskCache = disk_calls(cache)
+    server = PyServer(callMap=calls, diskCache=diskCache)
+    if stats:
+        server.metrics.dump_every(lambda *args: metricslog(*args), stats)
     server.accept_clients()
     server.operate()
 
+def test_async_server(cache: str="", stats: float=60.):
+    calls, diskCache = disk_calls(cache)
+    server = AsyncPyServer(callMap=calls, diskCache=diskCache)
+    if stats:
+        server.metrics.dump_every(lambda *args: metricslog(*args), stats)
+    server.operate()
+
 
 
 
 
 
 parser = argh.ArghParser()
-parser.add_commands([test_server,])
+parser.add_commands([test_server, test_async_server])
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     IP = Address("127.0.0.1", 31775)
     LM = logdumps.initialise_log_manager()
     LM.add_file(logdumps.create_log_target("networklog", "c:/workshop/tools/networklog.txt"))
     networklog = LM.create_log({"networklog", "stdout"}, defaultKwargs={"flush": True})
+    LM.add_file(logdumps.create_log_target("metricslog", "c:/workshop/tools/metricslog.txt"))
+    metricslog = LM.create_log({"metricslog"})
     parser.dispatch()
     
     
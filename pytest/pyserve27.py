@@ -2,19 +2,31 @@
 
 
 
+import errno
+import mmap
+import os
+import platform
+import select
 import socket as sockets
 import threading
 import time
 import traceback
 import struct
+from collections import deque, OrderedDict
 
 import msgpack
 
-from pyserveconst import PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_FUNCTION_ID, PY_CONNECT_ARGS_ID, PY_CONNECT_RETURN
+from pyserveconst import PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_PATH, PY_CONNECT_SHM, PY_CONNECT_FUNCTION_ID, PY_CONNECT_ARGS_ID, PY_CONNECT_RETURN, PY_CONNECT_ERROR, PY_CONNECT_REQUEST_ID, PY_CONNECT_BATCH_ID, PY_CONNECT_ONEWAY_ID
+from pyserveconst import PY_CONNECT_STREAM_ID, PY_CONNECT_CHUNK, PY_CONNECT_END
+from pyserveconst import PY_CONNECT_TOPIC, PY_CONNECT_SUBSCRIBE, PY_CONNECT_UNSUBSCRIBE, PY_CONNECT_HANDSHAKE, PY_CONNECT_PROTOCOL
+from pyserveconst import PY_CONNECT_INVALIDATE, PY_CONNECT_PING, PY_CONNECT_DEADLINE_ID, PY_CONNECT_CANCEL_ID
+from pyserveconst import PY_CONNECT_PRIORITY_ID, PY_CONNECT_REALTIME, PY_CONNECT_INTERACTIVE, PY_CONNECT_BULK
+from pyserveconst import PY_CONNECT_STATS
 
 CALL = '& "C:\\Users\\frogb\\AppData\\Local\\Programs\\Python\\Python27\\python.exe" c:/workshop/tools/pyserve27.py'
 
 INFO_BYTES = 4
+IOV_MAX = 512
 
 def call(func):
     "calls function in a subthread and returns that thread"
@@ -24,60 +36,460 @@ def call(func):
     t.start()
     return t
 
+def text(s):
+    "function names and topics must reach the server as str, not the bin a python 2 byte string packs as"
+    return s.decode("utf-8") if type(s) is bytes else s
+
+def texts(value):
+    """
+    value with every python 2 byte string in it decoded, however deeply
+    nested, so string arguments reach the server as str too. ones that
+    aren't utf-8 are left to go as bin, as is a bytearray. on python 3 and
+    IronPython, where str is already text, value is returned as it is
+    """
+    if bytes is not str:
+        return value
+    if type(value) is bytes:
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return value
+    if type(value) in (list, tuple):
+        return [texts(item) for item in value]
+    if type(value) is dict:
+        return dict((texts(key), texts(item)) for key, item in value.items())
+    return value
+
+def cache_key(args):
+    "args packed, as the server's Memo keys results, so that 1, 1.0 and True aren't taken for the same call"
+    return msgpack.dumps(list(args), use_bin_type=True)
+
+def msgparts(data):
+    "packs data into the (header, body) of a frame without copying the body to join them"
+    serialised = msgpack.dumps(data, use_bin_type=True)
+    return struct.pack(">L", len(serialised)), serialised
+
 def msgsend(socket, data):
-    serialised = msgpack.dumps(data)
-    packet = struct.pack(">L", len(serialised)) + serialised
-    socket.send(packet)
+    sendv(socket, msgparts(data))
+
+def sendv(socket, buffers):
+    "writes every buffer in order using scatter/gather sends, carrying on after short writes"
+    if not hasattr(socket, "sendmsg"): # python 2, IronPython and windows
+        socket.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    i = 0
+    while i < len(views):
+        sent = socket.sendmsg(views[i:i + IOV_MAX])
+        while sent:
+            if sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+
+def tune(socket, nodelay=True, sndbuf=0, rcvbuf=0):
+    "applies TCP_NODELAY and, when non-zero, the kernel send/receive buffer sizes"
+    if socket.family == sockets.AF_INET:
+        socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, int(nodelay))
+    if sndbuf:
+        socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, rcvbuf)
 
 def msgrecv(socket):
-    length = struct.unpack(">L", socket.recv(INFO_BYTES))[0]
-    raw = socket.recv(length)
-    data = msgpack.loads(raw)
-    return data
+    "reads one whole frame"
+    length = struct.unpack(">L", recvexact(socket, INFO_BYTES))[0]
+    return msgpack.loads(bytes(recvexact(socket, length)), raw=False)
+
+def recvexact(socket, length):
+    "reads exactly length bytes, raising EOFError if the socket closes first"
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < length:
+        received = socket.recv_into(view[offset:])
+        if not received:
+            raise EOFError("connection closed mid-frame")
+        offset += received
+    return buffer
+
+class FrameReader:
+    """
+    Receive engine, same as pyservertools.FrameReader. Each read is one
+    recv_into a buffer allocated up front, and frame bodies are fed to a
+    long-lived Unpacker as their bytes arrive. read returns every frame
+    the recv completed
+    """
+    def __init__(self, socket, bufferSize=1 << 16):
+        self.socket = socket
+        self.view = memoryview(bytearray(bufferSize))
+        self.unpacker = msgpack.Unpacker(raw=False)
+        self.header = bytearray()
+        self.remaining = 0 # body bytes of the current frame still to come
+        self.inBody = False
+
+    def read(self):
+        "blocks for one recv and returns the frames it completed. None once the peer has gone away"
+        received = self.socket.recv_into(self.view)
+        if not received:
+            return None
+        frames = []
+        i = 0
+        while i < received:
+            if not self.inBody:
+                take = min(INFO_BYTES - len(self.header), received - i)
+                self.header += self.view[i:i + take]
+                i += take
+                if len(self.header) == INFO_BYTES:
+                    self.remaining = struct.unpack(">L", bytes(self.header))[0]
+                    del self.header[:]
+                    self.inBody = self.remaining > 0
+                continue
+            take = min(self.remaining, received - i)
+            self.unpacker.feed(self.view[i:i + take])
+            i += take
+            self.remaining -= take
+            if not self.remaining:
+                frames.append(self.unpacker.unpack())
+                self.inBody = False
+        return frames
+
+AF_SHM = "shm"
+SHM_CREATED = 0
+SHM_ACCEPTED = 1
+try:
+    from multiprocessing import cpu_count
+except ImportError: # IronPython
+    cpu_count = lambda: int(os.environ.get("NUMBER_OF_PROCESSORS", 1))
+SHM_SPINS = 1000 if cpu_count() > 1 else 0 # spinning on one core only starves the other side
+SHM_LIVENESS = 1.
+SHM_SUPPORTED = (platform.machine() or os.environ.get("PROCESSOR_ARCHITECTURE", "")).lower() in ("x86_64", "amd64", "x86", "i386", "i686")
+
+def spin_wait(ready, timeout=None, spins=SHM_SPINS, alive=None):
+    "pyservertools.spin_wait. busy-polls, then sleeps in steps doubling up to half a millisecond, checking alive() every SHM_LIVENESS seconds"
+    for _ in range(spins):
+        if ready():
+            return True
+        time.sleep(0) # lets other threads have the GIL without giving up the core
+    deadline = None if timeout is None else time.time() + timeout
+    checked = time.time()
+    delay = 1e-5
+    while not ready():
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            return False
+        if alive is not None and now - checked >= SHM_LIVENESS:
+            if not alive():
+                return ready()
+            checked = now
+        time.sleep(delay)
+        delay = min(delay * 2, 5e-4)
+    return True
+
+def process_alive(pid):
+    "whether process pid is still running. always True on windows, where there's no cheap way to ask from here"
+    if os.name == "nt" or not hasattr(os, "kill"):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+class Ring:
+    "pyservertools.Ring, the single-producer single-consumer byte ring in a shared mmap"
+    HEADER = 192
+
+    def __init__(self, map, offset, capacity):
+        self.map = map
+        self.offset = offset
+        self.data = offset + self.HEADER
+        self.capacity = capacity
+
+    def head(self):
+        return struct.unpack_from("<Q", self.map, self.offset)[0]
+
+    def tail(self):
+        return struct.unpack_from("<Q", self.map, self.offset + 64)[0]
+
+    def closed(self):
+        return struct.unpack_from("<Q", self.map, self.offset + 128)[0] != 0
+
+    def close(self):
+        struct.pack_into("<Q", self.map, self.offset + 128, 1)
+
+    def readable(self):
+        return self.head() - self.tail()
+
+    def writable(self):
+        return self.capacity - (self.head() - self.tail())
+
+    def write(self, data):
+        "copies as much of data (a memoryview) as fits and returns how much that was"
+        head = self.head()
+        count = min(len(data), self.capacity - (head - self.tail()))
+        position = head % self.capacity
+        first = min(count, self.capacity - position)
+        self.map[self.data + position:self.data + position + first] = data[:first].tobytes()
+        self.map[self.data:self.data + count - first] = data[first:count].tobytes()
+        struct.pack_into("<Q", self.map, self.offset, head + count)
+        return count
+
+    def read_into(self, view):
+        "copies as much as is waiting into view and returns how much that was"
+        tail = self.tail()
+        count = min(len(view), self.head() - tail)
+        position = tail % self.capacity
+        first = min(count, self.capacity - position)
+        view[:first] = self.map[self.data + position:self.data + position + first]
+        view[first:count] = self.map[self.data:self.data + count - first]
+        struct.pack_into("<Q", self.map, self.offset + 64, tail + count)
+        return count
+
+class ShmSocket:
+    """
+    Client end of pyservertools.ShmSocket: a ring each way in one mapped
+    file, with as much of the socket interface as Client and FrameReader use.
+    Only offered on x86, like the server's
+    """
+    family = AF_SHM
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.map = None
+        self.path = ""
+
+    def open(self, path):
+        self.path = path
+        with open(path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.capacity = struct.unpack_from("<Q", self.map, 8)[0]
+        self.sending = Ring(self.map, 64, self.capacity)
+        self.receiving = Ring(self.map, 64 + Ring.HEADER + self.capacity, self.capacity)
+
+    def alive(self):
+        "whether the server's process is still running. closes the rings once it isn't"
+        pid = struct.unpack_from("<Q", self.map, 24)[0]
+        if not pid or process_alive(pid):
+            return True
+        self.sending.close()
+        self.receiving.close()
+        return False
+
+    def connect(self, directory, timeout=5.):
+        "creates a ring file in the server's directory and waits for the server to take it"
+        if not SHM_SUPPORTED:
+            raise ValueError("the shared memory transport needs an x86 machine")
+        name = os.path.join(directory, "%d-%d-%d" % (os.getpid(), id(self), int(time.time() * 1e6)))
+        with open(name + ".tmp", "wb") as f:
+            f.write(struct.pack("<QQQ", SHM_CREATED, self.capacity, os.getpid()))
+            f.truncate(64 + 2 * (Ring.HEADER + self.capacity))
+        os.rename(name + ".tmp", name + ".ring") # the server only looks at whole files
+        self.open(name + ".ring")
+        if not spin_wait(lambda: struct.unpack_from("<Q", self.map, 0)[0] == SHM_ACCEPTED, timeout, spins=0):
+            self.close()
+            raise sockets.error(errno.ECONNREFUSED, "nothing accepted %s.ring" % name)
+
+    def setsockopt(self, *args):
+        pass
+
+    def poll(self, timeout=0.):
+        "whether a recv would return straight away, waiting up to timeout (None waits forever)"
+        ready = lambda: self.receiving.readable() or self.receiving.closed()
+        return ready() if timeout == 0. else spin_wait(ready, timeout, alive=self.alive)
+
+    def recv_into(self, view):
+        "blocks until bytes arrive and reads what fits. 0 once either side has closed"
+        self.poll(None)
+        if self.receiving.closed() and not self.receiving.readable():
+            return 0
+        return self.receiving.read_into(view)
+
+    def sendall(self, data):
+        "blocks until all of data is in the ring"
+        data = memoryview(data)
+        while data:
+            if self.sending.closed():
+                raise sockets.error(errno.EPIPE, "shared memory peer closed")
+            sent = self.sending.write(data)
+            data = data[sent:]
+            if data:
+                spin_wait(lambda: self.sending.writable() or self.sending.closed(), alive=self.alive)
+
+    def close(self):
+        "marks both rings closed so each side's reader sees the end of the stream"
+        if self.map is None:
+            return
+        self.sending.close()
+        self.receiving.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def readable(socket, timeout):
+    "whether socket has something to read within timeout (None waits forever)"
+    if isinstance(socket, ShmSocket):
+        return socket.poll(timeout)
+    return bool(select.select([socket], [], [], timeout)[0])
+
+QUEUE_BLOCK = "block"
+QUEUE_DROP = "drop"
+QUEUE_REJECT = "reject"
+
+class QueueFull(Exception):
+    "raised by Queue.enqueue when a full queue uses the reject policy"
+
+def wait_for(condition, predicate, timeout):
+    "Condition.wait_for for python 2. timeout None waits forever, 0 polls"
+    if timeout is None:
+        while not predicate():
+            condition.wait()
+        return True
+    end = time.time() + timeout
+    while not predicate():
+        remaining = end - time.time()
+        if remaining <= 0:
+            return False
+        condition.wait(remaining)
+    return True
 
 class Queue:
     "thread safe queue (made of requests system)"
     """
-    Thread-safe single-element-expanding queue. Queue with dequeue and enqueue.
-    Random access via __index__
+    Thread-safe FIFO queue, same behaviour as pyservertools.Queue.
+    Elements are released as soon as they are dequeued.
+
+    dequeue and dequeue_batch wait up to timeout seconds for an element;
+    0 polls and None waits forever.
+
+    capacity 0 means unbounded. Once a bounded queue is full the policy
+    decides what enqueue does: block, drop (the oldest) or reject.
+
+    close wakes every waiter; after it dequeue only drains what is left and
+    enqueue refuses new elements
     """
-    def __init__(self):
-        self.list = []
+    def __init__(self, capacity=0, policy=QUEUE_BLOCK):
+        self.list = deque()
+        self.capacity = capacity
+        self.policy = policy
         self.lock = threading.Lock()
-        self.i = 0
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        self.dropped = 0
+        self.closed = False
 
     def __repr__(self):
-        return "Q{}:{}".format(self.i, self.list)
+        return "Q{}:{}".format(len(self.list), list(self.list))
+
+    def __len__(self):
+        return len(self.list)
+
+    def full(self):
+        return bool(self.capacity) and len(self.list) >= self.capacity
 
-    def dequeue(self):
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+
+    def dequeue(self, timeout=0.):
         with self.lock:
-            if self.i >= len(self.list):
+            if not wait_for(self.notEmpty, lambda: self.list or self.closed, timeout) or not self.list:
                 return
-            element = self.list[self.i]
-            self.i += 1
+            element = self.list.popleft()
+            self.notFull.notify()
         return element
 
-    def enqueue(self, element):
+    def dequeue_batch(self, max_n, timeout=0.):
+        "dequeues up to max_n elements, waiting only for the first"
+        with self.lock:
+            if not wait_for(self.notEmpty, lambda: self.list or self.closed, timeout) or not self.list:
+                return []
+            batch = [self.list.popleft() for _ in range(min(max_n, len(self.list)))]
+            self.notFull.notify(len(batch))
+        return batch
+
+    def enqueue(self, element, timeout=None):
+        "returns False if the queue is closed or a blocking enqueue timed out before there was room"
         with self.lock:
+            if self.closed:
+                return False
+            if self.full():
+                if self.policy == QUEUE_REJECT:
+                    raise QueueFull("queue is at capacity ({})".format(self.capacity))
+                elif self.policy == QUEUE_DROP:
+                    self.list.popleft()
+                    self.dropped += 1
+                elif not wait_for(self.notFull, lambda: not self.full() or self.closed, timeout) or self.closed:
+                    return False
             self.list.append(element)
+            self.notEmpty.notify()
+        return True
 
 class Address:
-    def __init__(self, ip, port):
-        self.ip, self.port = ip, port
+    """
+    a TCP host and port. for same-host traffic, an AF_UNIX socket path when
+    path is set, or a shared memory rendezvous directory when shm is set
+    """
+    def __init__(self, ip, port, path="", shm=""):
+        self.ip, self.port, self.path, self.shm = ip, port, path, shm
 
     def astuple(self):
         return self.ip, self.port
 
+    def family(self):
+        return sockets.AF_UNIX if self.path else sockets.AF_INET
+
+    def sockaddr(self):
+        "what connect takes for this address"
+        return self.shm or self.path or self.astuple()
+
+class Ids:
+    "request ids, shared by a Pool's connections so an id names one call whichever socket it went out on"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = 0
+
+    def next(self):
+        with self.lock:
+            self.last += 1
+            return self.last
+
+
 class Client:
     """
     Client that forms and control the connection and communication
     to and from the Server
 
     self.socket: socket.socket
+    self.replies: dict # request id -> replies read while waiting for another
+    self.handles: dict # request id -> Pending filled in when its reply is filed
+    self.abandoned: set # ids of streams whose remaining replies are dropped
+    self.published: Queue # (topic, data) pushed by the server
+    self.invalidated: callable # given each [function, args] invalidation the server pushes
     """
-    def __init__(self, ip):
-        self.socket = sockets.socket()
+    def __init__(self, ip, nodelay=True, sndbuf=0, rcvbuf=0, ids=None):
+        self.socket = ShmSocket() if ip.shm else sockets.socket(ip.family())
+        tune(self.socket, nodelay, sndbuf, rcvbuf)
+        self.reader = FrameReader(self.socket)
+        self.frames = deque()
         self.ip = ip
+        self.sendLock = threading.Lock()
+        self.arrived = threading.Condition() # guards what's read off the socket. notified as each frame is filed
+        self.reading = False # whether a thread is reading the socket. only one does at a time
+        self.reader_thread = None
+        self.error = None # what ended the background reader
+        self.replies = {}
+        self.handles = {} # request id -> Pending from request_async
+        self.abandoned = set()
+        self.published = Queue()
+        self.invalidated = lambda invalidation: None
+        self.ids = ids or Ids()
+        self.lastUsed = time.time()
 
     def __del__(self):
         self.close()
@@ -87,29 +499,686 @@ class Client:
         self.connect()
 
     def connect(self):
-        self.socket.connect(self.ip.astuple())
+        self.socket.connect(self.ip.sockaddr())
 
     def send(self, data):
         msgsend(self.socket, data)
 
     def recv(self):
-        return msgrecv(self.socket)
+        "the next frame, reading more off the socket only once the last read's are used up"
+        while not self.frames:
+            frames = self.reader.read()
+            if frames is None:
+                raise EOFError("server closed the connection")
+            self.frames.extend(frames)
+        return self.frames.popleft()
+
+    def post(self, packet):
+        "sends packet from any thread without expecting a reply"
+        with self.sendLock:
+            self.send(packet)
+
+    def request(self, packet, timeout=None):
+        "sends packet tagged with a fresh request id, and a deadline timeout seconds away if given, and returns the id"
+        reqid = self.ids.next()
+        packet[PY_CONNECT_REQUEST_ID] = reqid
+        if timeout is not None:
+            packet[PY_CONNECT_DEADLINE_ID] = timeout
+        with self.sendLock:
+            self.send(packet)
+        return reqid
+
+    def request_call(self, funcId, args, timeout=None):
+        "sends a positional [id, reqid, args] call (see PyClient.handshake) and returns its request id"
+        reqid = self.ids.next()
+        frame = [funcId, reqid, args] if timeout is None else [funcId, reqid, args, timeout]
+        with self.sendLock:
+            self.send(frame)
+        return reqid
+
+    def request_async(self, packet, timeout=None):
+        "request, returning a Pending for the reply instead of the id"
+        reqid = self.ids.next()
+        packet[PY_CONNECT_REQUEST_ID] = reqid
+        if timeout is not None:
+            packet[PY_CONNECT_DEADLINE_ID] = timeout
+        handle = Pending(self, reqid)
+        with self.arrived:
+            self.handles[reqid] = handle
+        with self.sendLock:
+            self.send(packet)
+        return handle
+
+    def cancel(self, reqid):
+        "tells the server the call is no longer wanted, and drops its reply when it comes"
+        self.abandon(reqid)
+        self.post({PY_CONNECT_CANCEL_ID: reqid})
+
+    def wait(self, reqid, timeout=None):
+        "reads replies until one for reqid arrives, keeping the rest for their own callers. cancels it after timeout seconds"
+        with self.arrived:
+            if not self.settle(lambda: reqid in self.replies, timeout):
+                self.cancel(reqid)
+                raise Timeout("no reply to request %d within %ss" % (reqid, timeout))
+            replies = self.replies[reqid]
+            resp = replies.popleft()
+            if not replies:
+                del self.replies[reqid]
+            return resp
+
+    def settle(self, ready, timeout=None):
+        """
+        reads frames until ready() is true, or leaves it to the thread already
+        reading and waits for it to file them. returns ready() after at most
+        timeout seconds (None waits forever). call with arrived held
+        """
+        end = None if timeout is None else time.time() + timeout
+        while not ready():
+            if self.error is not None:
+                raise self.error
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            if self.reading:
+                self.arrived.wait(remaining)
+            else:
+                self.take_turn(remaining)
+        return True
+
+    def take_turn(self, timeout):
+        "reads and files one frame if any arrives within timeout. call with arrived held and nobody reading"
+        self.reading = True
+        self.arrived.release()
+        resp = None
+        try:
+            if self.frames or readable(self.socket, timeout):
+                resp = self.recv()
+        finally:
+            self.arrived.acquire()
+            self.reading = False
+            if resp is not None:
+                self.route(resp)
+            self.arrived.notify_all()
+
+    def route(self, resp):
+        "files a frame read off the socket. call with arrived held"
+        if PY_CONNECT_TOPIC in resp:
+            self.published.enqueue((resp[PY_CONNECT_TOPIC], resp[PY_CONNECT_RETURN]))
+            return
+        if PY_CONNECT_INVALIDATE in resp:
+            self.invalidated(resp[PY_CONNECT_INVALIDATE])
+            return
+        respId = resp.get(PY_CONNECT_REQUEST_ID)
+        if respId in self.abandoned:
+            if PY_CONNECT_CHUNK not in resp:
+                self.abandoned.discard(respId)
+            return
+        handle = self.handles.pop(respId, None)
+        if handle is not None:
+            handle.fulfil(resp)
+            return
+        self.replies.setdefault(respId, deque()).append(resp)
+
+    def pump(self, timeout=0.):
+        "reads and files one frame if any arrives within timeout (None waits forever)"
+        with self.arrived:
+            if self.reading:
+                self.arrived.wait(timeout)
+            else:
+                self.take_turn(timeout)
+
+    def drain(self):
+        "files every frame that has already arrived, without waiting. does nothing if another thread is reading"
+        with self.arrived:
+            if self.error is not None:
+                raise self.error
+            while not self.reading and (self.frames or readable(self.socket, 0.)):
+                self.take_turn(0.)
+
+    def start_reader(self):
+        "files frames on a background thread as they arrive, so Pendings complete without anyone waiting on them"
+        with self.arrived:
+            if self.reader_thread is not None:
+                return
+            self.reader_thread = threading.Thread(target=self.read_forever)
+            self.reader_thread.daemon = True
+            self.reader_thread.start()
+
+    def read_forever(self):
+        with self.arrived:
+            while True:
+                try:
+                    self.settle(lambda: False)
+                except (sockets.error, EOFError, ValueError) as e: # ValueError: a closed socket
+                    self.fail(e)
+                    return
+
+    def fail(self, error):
+        "ends every Pending with error. call with arrived held"
+        self.error = error
+        handles, self.handles = self.handles, {}
+        for handle in handles.values():
+            handle.fulfil(None, error)
+        self.arrived.notify_all()
+
+    def ping(self, timeout=None):
+        "a round trip that runs nothing on the server. raises if the connection is dead, or Timeout after timeout seconds"
+        self.wait(self.request({PY_CONNECT_FUNCTION_ID: PY_CONNECT_PING, PY_CONNECT_ARGS_ID: ()}, timeout), timeout)
+
+    def abandon(self, reqid):
+        "drops the rest of a stream nobody is going to read"
+        with self.arrived:
+            replies = self.replies.pop(reqid, ())
+            if not any(PY_CONNECT_CHUNK not in resp for resp in replies):
+                self.abandoned.add(reqid)
 
     def close(self):
         self.socket.close()
 
 
-class PyClient:
+class RemoteError(Exception):
+    "raised by PyClient when the server reports that a call failed"
+
+
+def unwrap(resp):
+    "return value of a response packet, raising RemoteError if the call failed"
+    if PY_CONNECT_ERROR in resp:
+        raise RemoteError(resp[PY_CONNECT_ERROR])
+    return resp[PY_CONNECT_RETURN]
+
+
+class Timeout(Exception):
+    "raised when a reply doesn't arrive in time"
+
+
+class Cancelled(Exception):
+    "raised by Pending.result once the call has been cancelled"
+
+
+class Pending:
+    """
+    The reply to a PyClient.remote_call_async call, for a frame loop to
+    check on instead of blocking:
+
+        handle = pyclient.remote_call_async("add", 45, 53)
+        ...
+        if handle.poll(): # in Update, each frame
+            total = handle.result()
+
+    Callbacks run on whichever thread files the reply: the connection's
+    background reader, or a thread calling poll or result. Unity objects
+    should only be touched from the main thread, so poll from Update rather
+    than touching them in a callback
+    """
+    def __init__(self, client, reqid):
+        self.client = client
+        self.reqid = reqid
+        self.resp = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.resp is not None or self.error is not None
+
+    def poll(self):
+        "files replies that have already arrived, without blocking, and returns done()"
+        if not self.done():
+            try:
+                self.client.drain()
+            except (sockets.error, EOFError, ValueError) as e:
+                with self.client.arrived:
+                    self.client.fail(e)
+        return self.done()
+
+    def result(self, timeout=None):
+        "the call's return value, waiting up to timeout seconds (None waits forever) before raising Timeout"
+        with self.client.arrived:
+            if not self.client.settle(self.done, timeout):
+                raise Timeout("no reply to request %d within %ss" % (self.reqid, timeout))
+        if self.error is not None:
+            raise self.error
+        return unwrap(self.resp)
+
+    def cancel(self):
+        "gives up on the call: the server drops it if it hasn't started yet. False if it had already finished"
+        with self.client.arrived:
+            if self.done():
+                return False
+            self.client.handles.pop(self.reqid, None)
+            self.fulfil(None, Cancelled("request %d was cancelled" % self.reqid))
+        self.client.cancel(self.reqid)
+        return True
+
+    def add_done_callback(self, callback):
+        "calls callback(self) once the reply is in, straight away if it already is"
+        with self.client.arrived:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def fulfil(self, resp, error=None):
+        "called by the Client, with arrived held, as the reply is filed"
+        self.resp, self.error = resp, error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class BatchCall:
+    "one call's slot in a Batch, filled in when the batch is flushed"
     def __init__(self):
-        self.client = Client(Address(PY_CONNECT_ADDR, PY_CONNECT_PORT))
-        self.client.connect()
-        self.queue = Queue()
+        self.resp = None
+
+    def done(self):
+        return self.resp is not None
+
+    def result(self):
+        if self.resp is None:
+            raise RuntimeError("batch has not been flushed yet")
+        return unwrap(self.resp)
+
+
+class Batch:
+    """
+    Collects calls and sends them to the server as a single batch frame on
+    flush, so a frame's worth of calls costs one round trip.
+
+        batch = pyclient.batch()
+        total = batch.call("add", 45, 53)
+        batch.flush()
+        total.result()
+
+    Also usable as a context manager, which flushes on exit.
+    """
+    def __init__(self, pyclient):
+        self.pyclient = pyclient
+        self.calls = []
+        self.handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call(self, f, *args):
+        "queues a call for the next flush and returns its BatchCall"
+        handle = BatchCall()
+        self.calls.append([text(f), texts(args)])
+        self.handles.append(handle)
+        return handle
+
+    def flush(self):
+        "sends every queued call in one frame, fills in their BatchCalls and returns them"
+        calls, handles = self.calls, self.handles
+        self.calls, self.handles = [], []
+        if not calls:
+            return handles
+        packet = {PY_CONNECT_BATCH_ID: calls}
+        if self.pyclient.priority is not None:
+            packet[PY_CONNECT_PRIORITY_ID] = self.pyclient.priority
+        timeout = self.pyclient.timeout
+        for handle, resp in zip(handles, unwrap(self.pyclient.lend(lambda client: client.wait(client.request(packet, timeout), timeout)))):
+            handle.resp = resp
+        return handles
+
+
+class Stub:
+    """
+    A server function bound to a PyClient by its handshake. Calls go out
+    as positional [id, reqid, args] frames, so no names are sent or looked up
+    """
+    def __init__(self, pyclient, name, funcId, arity):
+        self.pyclient = pyclient
+        self.name, self.funcId, self.arity = name, funcId, arity
+
+    def __repr__(self):
+        return "<Stub %s #%d>" % (self.name, self.funcId)
+
+    def __call__(self, *args):
+        self.check(args)
+        args = texts(args)
+        timeout = self.pyclient.timeout
+        return unwrap(self.pyclient.lend(lambda client: client.wait(client.request_call(self.funcId, args, timeout), timeout)))
+
+    def nowait(self, *args):
+        "sends the call without waiting for its reply. pass the returned id to PyClient.result"
+        self.check(args)
+        args = texts(args)
+        return self.pyclient.dispatch(lambda client: client.request_call(self.funcId, args, self.pyclient.timeout))
+
+    def check(self, args):
+        if 0 <= self.arity < len(args):
+            raise TypeError("%s takes at most %d arguments (%d given)" % (self.name, self.arity, len(args)))
+
+
+class Functions(object):
+    "namespace of Stubs, filled in by PyClient.handshake"
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class Pool:
+    """
+    Connections to one server, lent out a call at a time so that threads
+    calling at once each get a socket to themselves instead of queueing on
+    one. The first is the home connection that subscriptions, streams,
+    batches and Stubs use, as it is the one the server keeps them on.
+
+    A connection is checked before it is lent out. It is replaced when the
+    server has hung up on it, or when it has sat unused for healthInterval
+    seconds and doesn't answer a ping within pingTimeout seconds (the
+    client's timeout, or else healthInterval). Calls that fail on a connection
+    (socket errors, EOFError) are passed to discard, which closes the
+    connection so that its next checkout replaces it. home checks the home
+    connection the same way each time it is asked for, as it is also used
+    without being checked out. Subscriptions don't survive a replacement
+    """
+    def __init__(self, connect, size=1, healthInterval=30., pingTimeout=None):
+        self.connect = connect # makes a new connected Client
+        self.healthInterval = healthInterval
+        self.pingTimeout = pingTimeout or healthInterval
         self.lock = threading.Lock()
-    
+        self.homeLock = threading.Lock()
+        self.clients = [connect() for _ in range(max(size, 1))]
+        self.idle = Queue()
+        for client in self.clients:
+            self.idle.enqueue(client)
+
+    def home(self):
+        "the home connection, replaced first if it isn't healthy"
+        client = self.clients[0]
+        if self.healthy(client):
+            client.lastUsed = time.time()
+            return client
+        with self.homeLock:
+            if self.clients[0] is client: # not already replaced by another thread
+                self.replace(client)
+            return self.clients[0]
+
+    def checkout(self):
+        "an idle, healthy connection. waits for one if every connection is busy"
+        client = self.idle.dequeue(None)
+        if self.healthy(client):
+            return client
+        try:
+            return self.replace(client)
+        except Exception:
+            self.idle.enqueue(client) # the server is down. leave it for the next checkout to retry
+            raise
+
+    def checkin(self, client):
+        client.lastUsed = time.time()
+        self.idle.enqueue(client)
+
+    def discard(self, client):
+        "closes a connection a call failed on. it is replaced the next time it is checked out"
+        client.close()
+        self.idle.enqueue(client)
+
+    def healthy(self, client):
+        try:
+            client.drain() # raises once the server has hung up
+            if time.time() - client.lastUsed > self.healthInterval:
+                client.ping(self.pingTimeout)
+        except (sockets.error, EOFError, ValueError, Timeout): # ValueError: a closed socket
+            return False
+        return True
+
+    def replace(self, client):
+        client.close()
+        with self.lock:
+            if client not in self.clients: # an old home connection that home has replaced since
+                return self.clients[0]
+        replacement = self.connect()
+        with self.lock:
+            self.clients[self.clients.index(client)] = replacement
+        return replacement
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+class PyClient(object):
+    """
+    pool connections are kept open to the server (see Pool), so up to that
+    many threads can make calls at the same time.
+
+    With a timeout, calls give up on their reply after that many seconds,
+    raising Timeout. The deadline goes to the server with the call, which
+    drops it unanswered if it comes up in its queue too late, and a cancel
+    follows a call that times out so the server stops spending time on it.
+    Streams are never timed out
+
+    The server queues calls in priority lanes, realtime, interactive and
+    bulk, and sheds the less urgent ones first when it is overloaded,
+    answering them with an Overloaded error. Calls go in their function's
+    lane unless the client is given a priority, or remote_call_at names one
+
+    With cache=True, remote_call keeps the results of functions the server
+    marks cacheable and answers repeat calls from them until the server
+    pushes an invalidation (see PyServer.invalidate) or their ttl runs out.
+    A hit costs a dict lookup and a non-blocking check for invalidations.
+    Past cacheSize results of one function the least recently used is dropped
+
+    self.cacheable: dict # function -> seconds its results stay fresh, 0 for until invalidated
+    self.results: dict # function -> OrderedDict {cache_key(args): (expiry time or 0, result)}, least recently used first
+    """
+    def __init__(self, nodelay=True, sndbuf=0, rcvbuf=0, ip=None, cache=False, pool=1, healthInterval=30., timeout=None,
+                 priority=None, cacheSize=1024):
+        self.ip = ip or Address(PY_CONNECT_ADDR, PY_CONNECT_PORT, PY_CONNECT_PATH, PY_CONNECT_SHM)
+        self.options = nodelay, sndbuf, rcvbuf
+        self.ids = Ids()
+        self.functions = Functions()
+        self.timeout = timeout
+        self.priority = priority
+        self.caching = cache
+        self.cacheSize = cacheSize
+        self.cacheable = {}
+        self.results = {}
+        self.epoch = 0 # counts invalidations, so a result that raced one isn't cached
+        self.pending = {} # request id -> connection its call_nowait went out on
+        self.pool = Pool(self.connect, pool, healthInterval, timeout)
+        if cache:
+            self.handshake()
+
+    @property
+    def client(self):
+        "the home connection. see Pool"
+        return self.pool.home()
+
+    def connect(self):
+        client = Client(self.ip, *self.options, ids=self.ids)
+        client.connect()
+        client.invalidated = self.forget
+        return client
+
+    def close(self):
+        self.pool.close()
+
+    def lend(self, work):
+        "runs work(client) on a connection from the pool and returns what it returns"
+        client = self.pool.checkout()
+        try:
+            result = work(client)
+        except (sockets.error, EOFError):
+            self.pool.discard(client)
+            raise
+        except Exception: # a Timeout, or a call msgpack couldn't encode. the connection is fine
+            self.pool.checkin(client)
+            raise
+        self.pool.checkin(client)
+        return result
+
+    def dispatch(self, send):
+        "runs send(client) on a pooled connection and remembers which for result. send returns a request id"
+        def sent(client):
+            reqid = send(client)
+            self.pending[reqid] = client
+            return reqid
+        return self.lend(sent)
+
+    def packet(self, f, args, priority=None):
+        "the packet calling f(*args), in priority's lane, or the client's if it was given one"
+        packet = {PY_CONNECT_FUNCTION_ID: text(f), PY_CONNECT_ARGS_ID: texts(args)}
+        priority = priority or self.priority
+        if priority is not None:
+            packet[PY_CONNECT_PRIORITY_ID] = priority
+        return packet
+
     def remote_call(self, f, *args):
-        self.client.send({PY_CONNECT_FUNCTION_ID: f, PY_CONNECT_ARGS_ID: args})
+        if self.cacheable:
+            return self.cached_call(f, args)
+        return self.remote_call_at(None, f, *args)
+
+    def remote_call_at(self, priority, f, *args):
+        "remote_call queued in the server's priority lane (PY_CONNECT_REALTIME, _INTERACTIVE or _BULK) instead"
+        packet = self.packet(f, args, priority)
         print("waiting")
-        return self.client.recv()[PY_CONNECT_RETURN]
+        return unwrap(self.lend(lambda client: client.wait(client.request(packet, self.timeout), self.timeout)))
+
+    def remote_call_async(self, f, *args):
+        """
+        sends a call and returns a Pending for its reply straight away. the
+        connection it went out on gets a background reader to fill it in
+        """
+        packet = self.packet(f, args)
+        def sent(client):
+            client.start_reader()
+            return client.request_async(packet, self.timeout)
+        return self.lend(sent)
+
+    def call_nowait(self, f, *args):
+        "sends a call without waiting for its reply. pass the returned id to result"
+        packet = self.packet(f, args)
+        return self.dispatch(lambda client: client.request(packet, self.timeout))
+
+    def notify(self, f, *args):
+        "one-way call. returns as soon as it is sent; the server runs it but never replies"
+        packet = self.packet(f, args)
+        packet[PY_CONNECT_ONEWAY_ID] = True
+        self.lend(lambda client: client.post(packet))
+
+    def stream(self, f, *args):
+        "calls a function that returns an iterator, yielding its items as they arrive"
+        packet = self.packet(f, args)
+        packet[PY_CONNECT_STREAM_ID] = True
+        client = self.client
+        reqid = client.request(packet)
+        finished = False
+        try:
+            while True:
+                resp = client.wait(reqid)
+                if PY_CONNECT_END in resp:
+                    finished = True
+                    return
+                if PY_CONNECT_CHUNK not in resp:
+                    finished = True
+                    for item in unwrap(resp):
+                        yield item
+                    return
+                for item in resp[PY_CONNECT_CHUNK]:
+                    yield item
+        finally:
+            if not finished:
+                client.abandon(reqid)
+
+    def subscribe(self, *topics):
+        "asks the server to push messages published to topics. read them with next_message"
+        return self.home_call(PY_CONNECT_SUBSCRIBE, [text(topic) for topic in topics])
+
+    def unsubscribe(self, *topics):
+        return self.home_call(PY_CONNECT_UNSUBSCRIBE, [text(topic) for topic in topics])
+
+    def home_call(self, f, args):
+        "a call that has to be made on the home connection, like the ones acting on its subscriptions"
+        client = self.client
+        return unwrap(client.wait(client.request({PY_CONNECT_FUNCTION_ID: f, PY_CONNECT_ARGS_ID: args}, self.timeout), self.timeout))
+
+    def stats(self):
+        "the server's metrics: call counts, errors and latencies by function, its queue and its connections"
+        return self.home_call(PY_CONNECT_STATS, ())
+
+    def next_message(self, timeout=0.):
+        "the next published (topic, data), or None if none arrives within timeout (None waits forever)"
+        end = None if timeout is None else time.time() + timeout
+        client = self.client
+        while True:
+            message = client.published.dequeue()
+            if message is not None:
+                return message
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining < 0:
+                return None
+            client.pump(remaining)
+
+    def handshake(self):
+        """
+        fetches the server's callMap and binds a Stub for each function in
+        self.functions, so hot calls can skip names: pc.functions.add(1, 2)
+        """
+        protocol, functions = self.home_call(PY_CONNECT_HANDSHAKE, ())
+        if protocol != PY_CONNECT_PROTOCOL:
+            raise RemoteError("server speaks protocol %d, this client %d" % (protocol, PY_CONNECT_PROTOCOL))
+        for name, funcId, arity, cache in functions:
+            setattr(self.functions, name, Stub(self, name, funcId, arity))
+            if cache >= 0 and self.caching:
+                self.cacheable[name] = cache
+        return self.functions
+
+    def cached_call(self, f, args):
+        "remote_call through the result cache"
+        self.pool.home() # checking the home connection files any invalidations waiting on it
+        ttl = self.cacheable.get(f)
+        packet = self.packet(f, args)
+        try:
+            key = None if ttl is None else cache_key(packet[PY_CONNECT_ARGS_ID])
+        except (TypeError, ValueError, OverflowError): # arguments msgpack can't encode are never cached
+            ttl = key = None
+        results = self.results.get(f, {})
+        entry = None if key is None else results.pop(key, None)
+        if entry is not None and (not entry[0] or time.time() < entry[0]):
+            results[key] = entry # back in as the most recently used
+            return entry[1]
+        epoch = self.epoch
+        value = unwrap(self.lend(lambda client: client.wait(client.request(packet, self.timeout), self.timeout)))
+        if ttl is not None and self.epoch == epoch:
+            results = self.results.setdefault(f, OrderedDict())
+            results[key] = (time.time() + ttl if ttl else 0, value)
+            if len(results) > self.cacheSize:
+                results.popitem(last=False)
+        return value
+
+    def forget(self, invalidation):
+        "drops the cached results a server invalidation covers"
+        func, args = invalidation
+        self.epoch += 1
+        if args is None:
+            self.results.pop(func, None)
+            return
+        try:
+            self.results.get(func, {}).pop(cache_key(args), None)
+        except (TypeError, ValueError, OverflowError):
+            self.results.pop(func, None)
+
+    def result(self, reqid):
+        "waits for the reply to a call_nowait call. replies can arrive in any order"
+        client = self.pending.pop(reqid, None) or self.client
+        try:
+            return unwrap(client.wait(reqid, self.timeout))
+        except (sockets.error, EOFError):
+            client.close() # so the pool replaces it next time it's lent out
+            raise
+
+    def batch(self):
+        "starts collecting calls to send together. see Batch"
+        return Batch(self)
 
 
 def main():
@@ -1,18 +1,38 @@
-
-
-import sys
-
 PY_CONNECT_ADDR = "127.0.0.1"
 PY_CONNECT_PORT = 31770
+PY_CONNECT_PATH = "" # AF_UNIX socket path. when set, server and client use it instead of addr/port
+PY_CONNECT_SHM = "" # shared memory rendezvous directory. when set it takes precedence over the above
 
-PY_CONNECT_FUNCTION_ID = "f"
-PY_CONNECT_ARGS_ID = "a"
-PY_CONNECT_RETURN = "r"
-PY_CONNECT_ERROR = "e"
-if sys.version[1] == "3":
-    PY_CONNECT_FUNCTION_ID = b"f"
-    PY_CONNECT_ARGS_ID = b"a"
-    PY_CONNECT_RETURN = b"r"
-    PY_CONNECT_ERROR = b"e"
+# bumped whenever the wire format changes. 2: text and bytes travel as msgpack
+# str and bin (use_bin_type=True, raw=False on both ends), so keys and
+# function names arrive as str and need no decoding. 3: handshake entries
+# say whether clients may cache the function's results. 4: calls can carry a
+# deadline, positional frames as a fourth element, and be cancelled
+PY_CONNECT_PROTOCOL = 4
 
+# the u prefix keeps these text on python 2, where a plain literal would pack as bin
+PY_CONNECT_FUNCTION_ID = u"f"
+PY_CONNECT_ARGS_ID = u"a"
+PY_CONNECT_RETURN = u"r"
+PY_CONNECT_ERROR = u"e"
+PY_CONNECT_REQUEST_ID = u"i"
+PY_CONNECT_BATCH_ID = u"b"
+PY_CONNECT_ONEWAY_ID = u"o"
+PY_CONNECT_STREAM_ID = u"s"
+PY_CONNECT_CHUNK = u"c"
+PY_CONNECT_END = u"d"
+PY_CONNECT_TOPIC = u"t"
+PY_CONNECT_INVALIDATE = u"x"
+PY_CONNECT_DEADLINE_ID = u"l" # seconds the caller will wait, counted from when the call is sent
+PY_CONNECT_CANCEL_ID = u"k" # request id of a call the caller has given up on
+PY_CONNECT_PRIORITY_ID = u"p" # lane a call is queued in, overriding its function's
+PY_CONNECT_SUBSCRIBE = u"__subscribe__"
+PY_CONNECT_UNSUBSCRIBE = u"__unsubscribe__"
+PY_CONNECT_HANDSHAKE = u"__handshake__"
+PY_CONNECT_PING = u"__ping__"
+PY_CONNECT_STATS = u"__stats__"
 
+# priority lanes, most urgent first. see PyServer
+PY_CONNECT_REALTIME = u"realtime"
+PY_CONNECT_INTERACTIVE = u"interactive"
+PY_CONNECT_BULK = u"bulk"
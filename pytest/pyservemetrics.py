@@ -0,0 +1,132 @@
+"""
+Metrics for pyserve: counters, latency histograms and gauges kept in a
+Registry, cheap enough to update on every call. Every Dispatcher has one
+that clients can read with the reserved __stats__ call, and that can be
+dumped to a logdumps log every so often with dump_every
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+
+from pyservertools import call
+
+class Counter:
+    "a count that only goes up"
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n: int=1):
+        with self.lock:
+            self.value += n
+
+    def read(self) -> int:
+        return self.value
+
+class Histogram:
+    """
+    Distribution of durations in seconds. Buckets double in size from a
+    microsecond, so recording one is a bisect and an increment and the
+    percentiles read back are accurate to within a factor of two
+    """
+    bounds = [1e-6 * 2 ** i for i in range(28)] # up to ~2 minutes. longer lands in the last bucket
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        i = bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        "upper bound of the bucket the q-th (0 to 1) observation falls in"
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return 0.
+
+    def read(self) -> dict:
+        with self.lock:
+            return {
+                "count": self.count,
+                "mean": self.total / self.count if self.count else 0.,
+                "p50": self.percentile(.5),
+                "p90": self.percentile(.9),
+                "p99": self.percentile(.99),
+                "max": self.max,
+            }
+
+class Gauge:
+    "a value read off something else whenever the registry is read, like the length of a queue"
+    __slots__ = ("read",)
+
+    def __init__(self, read: Callable[[], object]):
+        self.read = read
+
+class Registry:
+    """
+    Metrics by name. counter and histogram make a metric the first time a
+    name is asked for and return the same one after, so hot paths can look
+    theirs up once and keep it. read gives every metric's current value,
+    which is what __stats__ answers with, so gauges should read as things
+    msgpack can encode
+
+    self.metrics: dict # name -> Counter, Histogram or Gauge
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def metric(self, name: str, make: type):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, make())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self.metric(name, Counter)
+
+    def histogram(self, name: str) -> Histogram:
+        return self.metric(name, Histogram)
+
+    def gauge(self, name: str, read: Callable[[], object]) -> Gauge:
+        "adds a gauge calling read, replacing any gauge already under name"
+        with self.lock:
+            gauge = self.metrics[name] = Gauge(read)
+        return gauge
+
+    def read(self) -> dict:
+        "name -> current value of every metric, in name order"
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {name: metric.read() for name, metric in metrics}
+
+    def dump(self, log: Callable[..., None]):
+        "logs a line per metric"
+        for name, value in self.read().items():
+            log(name, value)
+
+    def dump_every(self, log: Callable[..., None], interval: float) -> threading.Thread:
+        "dumps to log every interval seconds on a daemon thread, which it returns"
+        def repeat():
+            while True:
+                time.sleep(interval)
+                self.dump(log)
+        return call(repeat)
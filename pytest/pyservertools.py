@@ -1,8 +1,15 @@
 
 
+import asyncio
+import mmap
+import os
+import platform
 import socket as sockets
+import sqlite3
 import struct
 import threading
+import time
+from collections import deque, OrderedDict
 from dataclasses import asdict, astuple
 
 import msgpack
@@ -20,19 +27,397 @@ def call(func: type(lambda:0), **kwargs) -> threading.Thread: # type(lambda:0) s
     t.start()
     return t
 
+IOV_MAX = 512 # buffers per sendmsg, comfortably under every platform's limit
+
+def msgparts(data: dict) -> tuple[bytes, bytes]:
+    "packs data into the (header, body) of a frame without copying the body to join them"
+    serialised = msgpack.dumps(data, use_bin_type=True)
+    return struct.pack(">L", len(serialised)), serialised
+
+def msgframe(data: dict) -> bytes:
+    "packs data into a length-prefixed frame ready to be written to a socket"
+    return b"".join(msgparts(data))
+
 def msgsend(socket: sockets.socket, data: dict):
-    serialised = msgpack.dumps(data)
-    packet = struct.pack(">L", len(serialised)) + serialised
-    socket.send(packet)
+    sendv(socket, msgparts(data))
+
+def sendv(socket: sockets.socket, buffers: list[bytes]):
+    "writes every buffer in order using scatter/gather sends, carrying on after short writes"
+    if not hasattr(socket, "sendmsg"): # windows
+        socket.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    i = 0
+    while i < len(views):
+        sent = socket.sendmsg(views[i:i + IOV_MAX])
+        while sent:
+            if sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+
+def tune(socket: sockets.socket, nodelay: bool=True, sndbuf: int=0, rcvbuf: int=0):
+    "applies TCP_NODELAY and, when non-zero, the kernel send/receive buffer sizes"
+    if socket.family in (sockets.AF_INET, sockets.AF_INET6):
+        socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, int(nodelay))
+    if sndbuf:
+        socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, rcvbuf)
 
 def msgrecv(socket: sockets.socket) -> dict:
+    "reads one whole frame. returns None once the peer has gone away"
+    try:
+        length = struct.unpack(">L", recvexact(socket, INFO_BYTES))[0]
+        return msgpack.loads(recvexact(socket, length), raw=False)
+    except EOFError:
+        return None
+
+def recvexact(socket: sockets.socket, length: int) -> bytearray:
+    "reads exactly length bytes, raising EOFError if the socket closes first"
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < length:
+        received = socket.recv_into(view[offset:])
+        if not received:
+            raise EOFError("connection closed mid-frame")
+        offset += received
+    return buffer
+
+class FrameReader:
+    """
+    Per-connection receive engine. Each read is one recv_into a buffer
+    allocated up front, and frame bodies are fed to a long-lived Unpacker
+    as their bytes arrive, so a frame can be any size without the reader
+    allocating for it. read returns every frame the recv completed, and
+    leaves how many bytes each came in, header and all, in sizes. A frame
+    whose body isn't exactly one object raises ValueError, as the stream
+    can't be trusted to line up with its headers after it
+    """
+    def __init__(self, socket: sockets.socket, bufferSize: int=1 << 16):
+        self.socket = socket
+        self.view = memoryview(bytearray(bufferSize))
+        self.unpacker = msgpack.Unpacker(raw=False)
+        self.header = bytearray()
+        self.remaining = 0 # body bytes of the current frame still to come
+        self.frameSize = 0
+        self.fed = 0 # body bytes fed to the unpacker so far, to check each frame against its tell
+        self.inBody = False
+        self.sizes = []
+
+    def read(self) -> list:
+        "blocks for one recv and returns the frames it completed. None once the peer has gone away"
+        received = self.socket.recv_into(self.view)
+        if not received:
+            return None
+        frames = []
+        self.sizes = []
+        i = 0
+        while i < received:
+            if not self.inBody:
+                take = min(INFO_BYTES - len(self.header), received - i)
+                self.header += self.view[i:i + take]
+                i += take
+                if len(self.header) == INFO_BYTES:
+                    self.remaining = struct.unpack(">L", self.header)[0]
+                    self.frameSize = INFO_BYTES + self.remaining
+                    self.header.clear()
+                    self.inBody = self.remaining > 0
+                continue
+            take = min(self.remaining, received - i)
+            self.unpacker.feed(self.view[i:i + take])
+            i += take
+            self.fed += take
+            self.remaining -= take
+            if not self.remaining:
+                try:
+                    frames.append(self.unpacker.unpack())
+                except msgpack.OutOfData:
+                    raise ValueError("frame body ends partway through an object") from None
+                if self.unpacker.tell() != self.fed:
+                    raise ValueError("frame body holds more than one object")
+                self.sizes.append(self.frameSize)
+                self.inBody = False
+        return frames
+
+async def amsgrecv(reader: asyncio.StreamReader) -> dict:
+    "msgrecv for asyncio streams. returns None once the peer has gone away"
     try:
-        length = struct.unpack(">L", socket.recv(INFO_BYTES))[0]
-    except struct.error:
+        header = await reader.readexactly(INFO_BYTES)
+        raw = await reader.readexactly(struct.unpack(">L", header)[0])
+        return msgpack.loads(raw, raw=False)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError): # ValueError covers malformed msgpack
         return None
-    raw = socket.recv(length)
-    data = msgpack.loads(raw)
-    return data
+
+AF_SHM = "shm" # family of ShmSocket, so tune and friends can tell it apart from real sockets
+SHM_CREATED = 0
+SHM_ACCEPTED = 1
+SHM_SPINS = 1000 if (os.cpu_count() or 1) > 1 else 0 # spinning on one core only starves the other side
+SHM_LIVENESS = 1. # seconds between checks that the other side of an idle ring is still running
+SHM_SUPPORTED = platform.machine().lower() in ("x86_64", "amd64", "x86", "i386", "i686") # see Ring
+
+def spin_wait(ready, timeout: float=None, spins: int=SHM_SPINS, alive=None) -> bool:
+    """
+    waits for ready() to come true. busy-polls spins times first, which is
+    what keeps a hot ring fast, then sleeps in steps that double up to half
+    a millisecond so an idle connection costs next to nothing. while
+    sleeping it calls alive(), if given, every SHM_LIVENESS seconds and
+    stops waiting once it returns False
+    """
+    for _ in range(spins):
+        if ready():
+            return True
+        time.sleep(0) # lets other threads have the GIL without giving up the core
+    deadline = None if timeout is None else time.monotonic() + timeout
+    checked = time.monotonic()
+    delay = 1e-5
+    while not ready():
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            return False
+        if alive is not None and now - checked >= SHM_LIVENESS:
+            if not alive():
+                return ready()
+            checked = now
+        time.sleep(delay)
+        delay = min(delay * 2, 5e-4)
+    return True
+
+def process_alive(pid: int) -> bool:
+    "whether process pid is still running"
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5 # access denied, so it exists
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Ring:
+    """
+    Single-producer single-consumer byte ring inside a shared mmap.
+    head and tail only ever grow and live on their own cache lines; only the
+    writer moves head and only the reader moves tail, so neither side locks.
+    Each side stores its counter after the bytes it covers. Python has no
+    memory barriers, so this relies on x86's total store order to make the
+    bytes visible before the counter; on weakly ordered CPUs such as ARM the
+    other side can see the counter first and read stale bytes, so the shared
+    memory transport is only offered on x86 (see SHM_SUPPORTED)
+
+    layout: head u64 | tail u64 | closed u64, each 64 byte aligned, then the data
+    """
+    HEADER = 192
+
+    def __init__(self, map: mmap.mmap, offset: int, capacity: int):
+        self.map = map
+        self.offset = offset
+        self.data = offset + self.HEADER
+        self.capacity = capacity
+
+    def head(self) -> int:
+        return struct.unpack_from("<Q", self.map, self.offset)[0]
+
+    def tail(self) -> int:
+        return struct.unpack_from("<Q", self.map, self.offset + 64)[0]
+
+    def closed(self) -> bool:
+        return struct.unpack_from("<Q", self.map, self.offset + 128)[0] != 0
+
+    def close(self):
+        struct.pack_into("<Q", self.map, self.offset + 128, 1)
+
+    def readable(self) -> int:
+        return self.head() - self.tail()
+
+    def writable(self) -> int:
+        return self.capacity - (self.head() - self.tail())
+
+    def write(self, data) -> int:
+        "copies as much of data as fits and returns how much that was"
+        head = self.head()
+        count = min(len(data), self.capacity - (head - self.tail()))
+        position = head % self.capacity
+        first = min(count, self.capacity - position)
+        self.map[self.data + position:self.data + position + first] = data[:first]
+        self.map[self.data:self.data + count - first] = data[first:count]
+        struct.pack_into("<Q", self.map, self.offset, head + count)
+        return count
+
+    def read_into(self, view: memoryview) -> int:
+        "copies as much as is waiting into view and returns how much that was"
+        tail = self.tail()
+        count = min(len(view), self.head() - tail)
+        position = tail % self.capacity
+        first = min(count, self.capacity - position)
+        view[:first] = self.map[self.data + position:self.data + position + first]
+        view[first:count] = self.map[self.data:self.data + count - first]
+        struct.pack_into("<Q", self.map, self.offset + 64, tail + count)
+        return count
+
+def check_shm():
+    "raises ValueError on machines the shared memory transport isn't safe on"
+    if not SHM_SUPPORTED:
+        raise ValueError(f"the shared memory transport needs an x86 machine, not {platform.machine()}")
+
+class ShmSocket:
+    """
+    Same-host transport over a pair of Rings in one memory-mapped file, one
+    ring each way. It carries the usual length-prefixed msgpack frames and
+    has as much of the socket interface as Connection, FrameReader, sendv
+    and Client use, so it drops in wherever they take a socket.
+
+    A client connects by creating a file in the server's directory; the
+    server's ShmListener maps it and marks it accepted. Each side writes its
+    pid, so a peer that dies without closing (a crashed or killed client)
+    is noticed on the sleep path of spin_wait and the rings closed for it.
+    Only offered on x86 (see Ring)
+
+    file layout: state u64 | capacity u64 | client pid u64 | server pid u64,
+    64 bytes, then the client to server Ring, then the server to client Ring
+    """
+    family = AF_SHM
+
+    def __init__(self, capacity: int=1 << 20):
+        self.capacity = capacity
+        self.map = None
+        self.path = ""
+
+    def open(self, path: str, client: bool):
+        self.path = path
+        with open(path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.capacity = struct.unpack_from("<Q", self.map, 8)[0]
+        upstream = Ring(self.map, 64, self.capacity)
+        downstream = Ring(self.map, 64 + Ring.HEADER + self.capacity, self.capacity)
+        self.sending, self.receiving = (upstream, downstream) if client else (downstream, upstream)
+        self.peerPid = 24 if client else 16 # where the other side's pid is
+
+    def alive(self) -> bool:
+        "whether the other side's process is still running. closes the rings once it isn't, as it never will"
+        pid = struct.unpack_from("<Q", self.map, self.peerPid)[0]
+        if not pid or process_alive(pid): # 0 is a peer that doesn't write its pid
+            return True
+        self.sending.close()
+        self.receiving.close()
+        return False
+
+    def connect(self, directory: str, timeout: float=5.):
+        "creates a ring file in a ShmListener's directory and waits for the server to take it"
+        check_shm()
+        name = os.path.join(directory, f"{os.getpid()}-{id(self)}-{time.monotonic_ns()}")
+        with open(name + ".tmp", "wb") as f:
+            f.write(struct.pack("<QQQ", SHM_CREATED, self.capacity, os.getpid()))
+            f.truncate(64 + 2 * (Ring.HEADER + self.capacity))
+        os.replace(name + ".tmp", name + ".ring") # the listener only looks at whole files
+        self.open(name + ".ring", client=True)
+        if not spin_wait(lambda: struct.unpack_from("<Q", self.map, 0)[0] == SHM_ACCEPTED, timeout, spins=0):
+            self.close()
+            raise ConnectionRefusedError(f"nothing accepted {name}.ring")
+
+    def settimeout(self, timeout: float):
+        pass
+
+    def setsockopt(self, *args):
+        pass # no kernel buffers to size; the ring capacity is fixed when connecting
+
+    def poll(self, timeout: float=0.) -> bool:
+        "whether a recv would return straight away, waiting up to timeout (None waits forever)"
+        ready = lambda: self.receiving.readable() or self.receiving.closed()
+        return ready() if timeout == 0. else spin_wait(ready, timeout, alive=self.alive)
+
+    def recv_into(self, view: memoryview) -> int:
+        "blocks until bytes arrive and reads what fits. 0 once either side has closed"
+        self.poll(None)
+        if self.receiving.closed() and not self.receiving.readable():
+            return 0
+        return self.receiving.read_into(memoryview(view))
+
+    def sendall(self, data):
+        "blocks until all of data is in the ring"
+        data = memoryview(data)
+        while data:
+            if self.sending.closed():
+                raise BrokenPipeError("shared memory peer closed")
+            sent = self.sending.write(data)
+            data = data[sent:]
+            if data:
+                spin_wait(lambda: self.sending.writable() or self.sending.closed(), alive=self.alive)
+
+    def sendmsg(self, buffers: list) -> int:
+        for buffer in buffers:
+            self.sendall(buffer)
+        return sum(len(buffer) for buffer in buffers)
+
+    def shutdown(self, how: int):
+        self.close()
+
+    def close(self):
+        "marks both rings closed so each side's reader sees the end of the stream"
+        if self.map is None:
+            return
+        self.sending.close()
+        self.receiving.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass # already gone, or still mapped on windows
+
+class ShmListener:
+    """
+    Stands in for a listening socket. accept picks up the ring files that
+    ShmSocket.connect creates in directory
+    """
+    family = AF_SHM
+
+    def __init__(self, directory: str, timeout: float=None):
+        check_shm()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.timeout = timeout
+        self.accepted = set() # names we couldn't unlink (windows) so must skip
+        self.pollInterval = 0.005
+
+    def settimeout(self, timeout: float):
+        self.timeout = timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def accept(self) -> tuple:
+        "the next ShmSocket to connect and its (directory, name). raises socket.timeout after timeout"
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            for name in sorted(os.listdir(self.directory)):
+                if name.endswith(".ring") and name not in self.accepted:
+                    self.accepted.add(name)
+                    conn = ShmSocket()
+                    conn.open(os.path.join(self.directory, name), client=False)
+                    struct.pack_into("<Q", conn.map, 24, os.getpid())
+                    struct.pack_into("<Q", conn.map, 0, SHM_ACCEPTED)
+                    try:
+                        os.unlink(conn.path) # stays mapped on both sides
+                    except OSError:
+                        pass
+                    return conn, (self.directory, name)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise sockets.timeout("no shared memory client")
+            time.sleep(self.pollInterval)
+
+    def close(self):
+        pass
 
 class Convertable:
     def astuple(self) -> tuple:
@@ -42,109 +427,502 @@ class Convertable:
         return asdict(self)
 
 
+QUEUE_BLOCK = "block"
+QUEUE_DROP = "drop"
+QUEUE_REJECT = "reject"
+
+class QueueFull(Exception):
+    "raised by Queue.enqueue when a full queue uses the reject policy"
+
 class Queue:
     "thread safe queue (made of requests system)"
     """
-    Thread-safe single-element-expanding queue. Queue with dequeue and enqueue.
-    Random access via __index__
+    Thread-safe FIFO queue. Elements are released as soon as they are
+    dequeued so a long-running queue stays the size of its backlog.
+
+    dequeue and dequeue_batch wait up to timeout seconds for an element;
+    0 polls and None waits forever.
+
+    capacity 0 means unbounded. Once a bounded queue is full the policy
+    decides what enqueue does:
+        block  - wait (up to timeout) for room
+        drop   - discard the oldest element to make room
+        reject - raise QueueFull
+
+    close wakes every waiter; after it dequeue only drains what is left and
+    enqueue refuses new elements
     """
-    def __init__(self):
-        self.list = []
+    def __init__(self, capacity: int=0, policy: str=QUEUE_BLOCK):
+        self.list = deque()
+        self.capacity = capacity
+        self.policy = policy
         self.lock = threading.Lock()
-        self.i = 0
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        self.dropped = 0
+        self.closed = False
 
     def __repr__(self) -> str:
-        return "Q{}:{}".format(self.i, self.list)
+        return "Q{}:{}".format(len(self.list), list(self.list))
 
-    def dequeue(self) -> dict:
+    def __len__(self) -> int:
+        return len(self.list)
+
+    def full(self) -> bool:
+        return bool(self.capacity) and len(self.list) >= self.capacity
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+
+    def dequeue(self, timeout: float=0.) -> dict:
         with self.lock:
-            if self.i >= len(self.list):
+            if not self.notEmpty.wait_for(lambda: self.list or self.closed, timeout) or not self.list:
                 return
-            element = self.list[self.i]
-            self.i += 1
+            element = self.list.popleft()
+            self.notFull.notify()
         return element
 
-    def enqueue(self, element: dict):
+    def dequeue_batch(self, max_n: int, timeout: float=0.) -> list:
+        "dequeues up to max_n elements, waiting only for the first"
         with self.lock:
+            if not self.notEmpty.wait_for(lambda: self.list or self.closed, timeout) or not self.list:
+                return []
+            batch = [self.list.popleft() for _ in range(min(max_n, len(self.list)))]
+            self.notFull.notify(len(batch))
+        return batch
+
+    def enqueue(self, element: dict, timeout: float=None) -> bool:
+        "returns False if the queue is closed or a blocking enqueue timed out before there was room"
+        with self.lock:
+            if self.closed:
+                return False
+            if self.full():
+                if self.policy == QUEUE_REJECT:
+                    raise QueueFull(f"queue is at capacity ({self.capacity})")
+                elif self.policy == QUEUE_DROP:
+                    self.list.popleft()
+                    self.dropped += 1
+                elif not self.notFull.wait_for(lambda: not self.full() or self.closed, timeout) or self.closed:
+                    return False
             self.list.append(element)
+            self.notEmpty.notify()
+        return True
 
+class Overloaded(QueueFull):
+    "raised by Lanes.enqueue when admission turns an element away"
 
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+class Fair:
+    """
+    Elements queued per owner and taken in deficit round robin, so an owner
+    with a lot queued can't hold up the rest. Each turn an owner is credited
+    weigh(owner) and takes an element per whole credit it has, carrying the
+    remainder over to its next turn for as long as it has elements waiting.
+    An owner weighing 2 takes twice as many as one weighing 1 and one
+    weighing .5 takes one every other turn. Not thread safe; see Lanes
+    """
+    def __init__(self, weigh=lambda owner: 1.):
+        self.weigh = weigh
+        self.queues = {} # owner -> deque of its elements
+        self.deficits = {} # owner -> credit left
+        self.turns = deque() # owners with elements waiting, the one taking its turn first
+        self.fresh = True # whether the owner at the front has yet to be credited for its turn
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, owner, element):
+        queue = self.queues.get(owner)
+        if queue is None:
+            queue = self.queues[owner] = deque()
+            self.deficits[owner] = 0.
+            self.turns.append(owner)
+        queue.append(element)
+        self.size += 1
+
+    def popleft(self):
+        "the next element. call only when there is one"
+        while True:
+            owner = self.turns[0]
+            if self.fresh:
+                self.deficits[owner] += self.weigh(owner)
+                self.fresh = False
+            if self.deficits[owner] >= 1:
+                break
+            self.next_turn()
+        queue = self.queues[owner]
+        element = queue.popleft()
+        self.size -= 1
+        self.deficits[owner] -= 1
+        if not queue:
+            del self.queues[owner], self.deficits[owner] # credit isn't saved up while idle
+            self.turns.popleft()
+            self.fresh = True
+        elif self.deficits[owner] < 1:
+            self.next_turn()
+        return element
 
+    def next_turn(self):
+        self.turns.rotate(-1)
+        self.fresh = True
 
+    def oldest(self):
+        "the element waiting longest, if elements are (time, ...). None if empty"
+        return min((queue[0] for queue in self.queues.values()), default=None, key=lambda element: element[0])
 
+class Lanes:
+    """
+    Queue with priority lanes. dequeue takes from the most urgent lane with
+    anything waiting, so urgent calls don't queue behind a burst of less
+    urgent ones. Within a lane elements are queued per owner(element) and
+    taken fairly between owners by weigh(owner) (see Fair), so a flood
+    from one owner only delays that owner. Without owner a lane is FIFO.
+
+    limits maps each lane, most urgent first, to the (depth, wait) past
+    which enqueue refuses its elements with Overloaded rather than queueing
+    them: depth is the most elements waiting in that lane and the more
+    urgent ones together and wait the most seconds the oldest of them may
+    have waited. 0 is no limit. Less urgent lanes aren't counted, as they
+    don't hold up the lane being checked. Giving less urgent lanes lower
+    limits sheds them first and keeps the backlog bounded. classify(element) names an element's lane; unknown
+    names go in the least urgent. observe(seconds) is told how long each
+    element waited as it is dequeued
+    """
+    def __init__(self, classify, limits: dict, owner=lambda element: None, weigh=lambda owner: 1.,
+                 observe=lambda seconds: None):
+        self.classify = classify
+        self.observe = observe
+        self.limits = limits
+        self.owner = owner
+        self.lanes = {lane: Fair(weigh) for lane in limits} # lane -> (enqueue time, element) by owner
+        self.order = list(self.lanes.values())
+        self.ahead = {lane: self.order[:i + 1] for i, lane in enumerate(self.lanes)} # lane -> it and the more urgent lanes
+        self.last = list(limits)[-1]
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.size = 0
+        self.refused = {lane: 0 for lane in limits}
+        self.closed = False
 
+    def __repr__(self) -> str:
+        return "Lanes{}".format({lane: len(waiting) for lane, waiting in self.lanes.items()})
 
+    def __len__(self) -> int:
+        return self.size
 
+    def waited(self, now: float, lanes: list) -> float:
+        "seconds the oldest element in lanes has been waiting. call with lock held"
+        return max((now - waiting.oldest()[0] for waiting in lanes if waiting), default=0.)
 
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+
+    def take(self):
+        "the next element by urgency. call with lock held and something waiting"
+        for waiting in self.order:
+            if waiting:
+                self.size -= 1
+                enqueued, element = waiting.popleft()
+                self.observe(time.monotonic() - enqueued)
+                return element
+
+    def dequeue(self, timeout: float=0.) -> dict:
+        with self.lock:
+            if not self.notEmpty.wait_for(lambda: self.size or self.closed, timeout) or not self.size:
+                return
+            return self.take()
 
+    def dequeue_batch(self, max_n: int, timeout: float=0.) -> list:
+        "dequeues up to max_n elements by urgency, waiting only for the first"
+        with self.lock:
+            if not self.notEmpty.wait_for(lambda: self.size or self.closed, timeout) or not self.size:
+                return []
+            return [self.take() for _ in range(min(max_n, self.size))]
+
+    def enqueue(self, element, timeout: float=None) -> bool:
+        "returns False if closed. raises Overloaded if the element's lane is past its limits"
+        lane = self.classify(element)
+        try:
+            depth, wait = self.limits[lane]
+        except (KeyError, TypeError): # unknown or unhashable names
+            lane = self.last
+            depth, wait = self.limits[lane]
+        ahead = self.ahead[lane]
+        now = time.monotonic()
+        with self.lock:
+            if self.closed:
+                return False
+            waiting = sum(map(len, ahead))
+            if (depth and waiting >= depth) or (wait and self.waited(now, ahead) > wait):
+                self.refused[lane] += 1
+                raise Overloaded(f"{lane} lane is past its limits ({waiting} waiting)")
+            self.lanes[lane].append(self.owner(element), (now, element))
+            self.size += 1
+            self.notEmpty.notify()
+        return True
+
+class Outbox:
+    """
+    Frames waiting for a connection's writer thread.
+
+    Replies are never dropped and reply never waits, so answering a call
+    can't hold up the thread doing it. Something producing reply after
+    reply, like a stream, calls room between them, which waits while
+    replyCapacity are already queued to hold it to the client's pace.
+    Posted frames (broadcasts) are held to capacity and once it is reached
+    the policy either drops the oldest posted frame or raises QueueFull.
+    take hands the writer everything waiting, replies first.
+
+    release(size) queues the size in bytes of a call whose replies are all
+    queued, behind them. take hands it to the writer among the frames, as
+    an int, so it can give back the call's budget once they are written
+    """
+    def __init__(self, capacity: int=256, policy: str=QUEUE_DROP, replyCapacity: int=1024):
+        self.replies = deque()
+        self.posted = deque()
+        self.capacity = capacity
+        self.replyCapacity = replyCapacity
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.roomForReplies = threading.Condition(self.lock)
+        self.dropped = 0
+        self.closed = False
 
+    def __len__(self) -> int:
+        return len(self.replies) + len(self.posted)
 
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+            self.roomForReplies.notify_all()
 
+    def reply(self, frame: tuple[bytes, bytes]) -> bool:
+        with self.lock:
+            if self.closed:
+                return False
+            self.replies.append(frame)
+            self.ready.notify()
+        return True
+
+    def room(self) -> bool:
+        "waits while replyCapacity replies are queued. False once closed"
+        with self.lock:
+            self.roomForReplies.wait_for(lambda: len(self.replies) < self.replyCapacity or self.closed)
+            return not self.closed
 
+    def release(self, size: int) -> bool:
+        return self.reply(size)
 
+    def post(self, frame: tuple[bytes, bytes]) -> bool:
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.posted) >= self.capacity:
+                if self.policy == QUEUE_REJECT:
+                    raise QueueFull(f"outbox is at capacity ({self.capacity})")
+                self.posted.popleft()
+                self.dropped += 1
+            self.posted.append(frame)
+            self.ready.notify()
+        return True
+
+    def take(self, max_n: int, timeout: float=None) -> list:
+        "up to max_n frames, waiting for the first. empty once closed"
+        with self.lock:
+            if not self.ready.wait_for(lambda: self.replies or self.posted or self.closed, timeout) or self.closed:
+                return []
+            frames = []
+            while self.replies and len(frames) < max_n:
+                frames.append(self.replies.popleft())
+            while self.posted and len(frames) < max_n:
+                frames.append(self.posted.popleft())
+            self.roomForReplies.notify_all()
+        return frames
+
+
+class Budget:
+    """
+    Work a connection has outstanding: calls read off it that haven't been
+    answered yet, and the bytes they arrived in. wait blocks while either
+    is at its limit (0 for none), which holds the connection's reader off
+    the socket until some are answered, so the client's sends back up
+    behind its own socket buffers rather than in the server's memory
+    """
+    def __init__(self, maxCalls: int=0, maxBytes: int=0):
+        self.maxCalls, self.maxBytes = maxCalls, maxBytes
+        self.calls = 0
+        self.bytes = 0
+        self.pauses = 0 # times wait has had to block
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.closed = False
 
+    def spent(self) -> bool:
+        return (self.maxCalls and self.calls >= self.maxCalls) or (self.maxBytes and self.bytes >= self.maxBytes)
 
+    def take(self, size: int):
+        with self.lock:
+            self.calls += 1
+            self.bytes += size
 
+    def give(self, size: int):
+        with self.lock:
+            self.calls -= 1
+            self.bytes -= size
+            if not self.spent():
+                self.room.notify()
 
+    def wait(self, timeout: float=None) -> bool:
+        "waits until there is room. False if closed or timed out first"
+        with self.lock:
+            if self.spent():
+                self.pauses += 1
+            return self.room.wait_for(lambda: not self.spent() or self.closed, timeout) and not self.closed
 
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.room.notify_all()
 
 
+class Packed:
+    "a return value along with the bytes msgpack packs it as, so it can be sent again without packing"
+    __slots__ = ("value", "raw")
 
+    def __init__(self, value, raw: bytes):
+        self.value = value
+        self.raw = raw
 
+class Memo:
+    """
+    Thread safe LRU cache with optional expiry, for the results of pure
+    functions keyed on their packed arguments. Past capacity the least
+    recently used entry is evicted; entries older than ttl seconds count
+    as misses and are evicted when next looked up. A ttl of 0 never expires
+    """
+    def __init__(self, capacity: int, ttl: float=0.):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expiry time or 0, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
+    def __len__(self) -> int:
+        return len(self.entries)
 
+    def get(self, key: bytes):
+        "the value stored under key, or None"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] and time.monotonic() >= entry[0]:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def discard(self, key: bytes):
+        with self.lock:
+            self.entries.pop(key, None)
 
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
+    def put(self, key: bytes, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl if self.ttl else 0, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
 
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
 
+class DiskCache:
+    """
+    sqlite3 store of packed results that outlives the server, the tier
+    behind the Memos of functions marked Remote(disk=True). Rows are keyed
+    on function name and packed arguments and tagged with the function's
+    version; a row from any other version is never served. Once the values
+    add up to more than maxBytes the least recently used rows are deleted
+    """
+    def __init__(self, path: str, maxBytes: int=256 << 20):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # a crash may lose the latest results, never corrupt the rest
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (func TEXT, key BLOB, version INTEGER, value BLOB, "
+                        "used REAL, PRIMARY KEY (func, key))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, func: str, version: int, key: bytes) -> bytes:
+        "the packed result stored for this call, or None"
+        with self.lock:
+            row = self.db.execute("SELECT version, value FROM results WHERE func = ? AND key = ?", (func, key)).fetchone()
+            if row is None or row[0] != version:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE results SET used = ? WHERE func = ? AND key = ?", (time.time(), func, key))
+            self.hits += 1
+            return row[1]
+
+    def put(self, func: str, version: int, key: bytes, value: bytes):
+        with self.lock:
+            old = self.db.execute("SELECT LENGTH(value) FROM results WHERE func = ? AND key = ?", (func, key)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (func, key, version, value, time.time()))
+            self.size += len(value) - (old[0] if old else 0)
+            if self.size <= self.maxBytes:
+                return
+            evicted = []
+            for func, key, length in self.db.execute("SELECT func, key, LENGTH(value) FROM results ORDER BY used"):
+                if self.size <= self.maxBytes:
+                    break
+                evicted.append((func, key))
+                self.size -= length
+            self.db.executemany("DELETE FROM results WHERE func = ? AND key = ?", evicted)
+            self.evictions += len(evicted)
+
+    def discard(self, func: str, key: bytes=None):
+        "deletes the result stored for one call of func, or all of func's if key is None"
+        where, params = ("func = ?", (func,)) if key is None else ("func = ? AND key = ?", (func, key))
+        with self.lock:
+            self.size -= self.db.execute(f"SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results WHERE {where}", params).fetchone()[0]
+            self.db.execute(f"DELETE FROM results WHERE {where}", params)
 
+    def invalidate(self, func: str, version: int) -> int:
+        "deletes func's results from versions other than version and returns how many there were"
+        with self.lock:
+            stale = self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM results "
+                                    "WHERE func = ? AND version != ?", (func, version)).fetchone()
+            self.db.execute("DELETE FROM results WHERE func = ? AND version != ?", (func, version))
+            self.size -= stale[1]
+            return stale[0]
 
+    def stats(self) -> dict:
+        with self.lock:
+            return {"bytes": self.size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
 
+    def close(self):
+        with self.lock:
+            self.db.close()